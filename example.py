@@ -24,6 +24,8 @@ for item, mtf, ect in zip(books, book_mtf, book_ect):
                      base64_html=f'{item}_64.html',
                      # base125_js=f'{item}_125.js',
                      base125_html=f'{item}_125.html',
+                     # base139_js=f'{item}_139.js',
+                     base139_html=f'{item}_139.html',
                      # crenc_js=f'{item}_cr.js',
                      crenc_html=f'{item}_cr.html')
     os.makedirs(output_folder, exist_ok=True)
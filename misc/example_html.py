@@ -13,9 +13,11 @@ from ztml import validation, ztml
 
 raw_files = ['30123_64.html',
              '30123_125.html',
+             '30123_139.html',
              '30123_cr.html',
              'test_pattern.jpg_64.html',
              'test_pattern.jpg_125.html',
+             'test_pattern.jpg_139.html',
              'test_pattern.jpg_cr.html'
              ]
 output_folder = '../output'
@@ -30,6 +32,8 @@ for url in raw_files:
                      base64_html=f'{item}_64.html',
                      # base125_js=f'{item}_125.js',
                      base125_html=f'{item}_125.html',
+                     # base139_js=f'{item}_139.js',
+                     base139_html=f'{item}_139.html',
                      # crenc_js=f'{item}_cr.js',
                      crenc_html=f'{item}_cr.html')
     os.makedirs(output_folder, exist_ok=True)
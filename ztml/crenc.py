@@ -10,6 +10,8 @@ with an overhead of ~ 3/256 ~ 1.2% (compared to 33.3% for Base64).
 JS does the unescaping, so the decoder only needs to take care of HTML character overrides for NUL and codes in 128 - 159.
 An optimal global character modular offset can be applied to minimize escaping, similar to dynEncode (enabled by default).
 A minimalistic JS decoder code is generated.
+Alternatively, a lookup decoder builds a code point to byte table once and fills a preallocated array,
+which is much faster for multi-MB payloads, at the cost of ~80 B of decoder code.
 
 References:
 https://en.wikipedia.org/wiki/Binary-to-text_encoding
@@ -21,6 +23,7 @@ https://stackoverflow.com/questions/10080605/special-character-u0098-read-as-u02
 """
 
 
+import sys
 from typing import Optional, Tuple
 
 if not __package__:
@@ -52,7 +55,9 @@ def optimize_encode(data: bytes) -> Tuple[bytes, int, int]:
 
 def get_js_decoder(data: bytes,
                    offset: Optional[int] = None,
-                   output_var: str = default_vars.bytearray
+                   output_var: str = default_vars.bytearray,
+                   lookup: bool = False,
+                   verbose: bool = False
                    ) -> bytes:
     if offset is None:
         encoded, offset, saved = optimize_encode(data)  # Time-consuming op.
@@ -63,4 +68,16 @@ def get_js_decoder(data: bytes,
     if offset:
         function = f'({function})-{offset}'
     last_part = f"`,c=>{function})\n"
+    if lookup:  # Build a code point to byte lookup table once, instead of searching the HTML character overrides per character
+        overrides = ''.join(chr(i) for i in range(128, 160))
+        lookup_first_part = 's=`'
+        lookup_last_part = f"""`
+m=new Uint8Array(65536).map((_,i)=>i{-offset or ''});[...'{overrides}'].map((c,i)=>m[c.charCodeAt()]=i+{128 - offset})
+for({output_var}=new Uint8Array(j=s.length);j--;){output_var}[j]=m[s.charCodeAt(j)%65533]
+"""
+        if verbose:
+            cost = len(lookup_first_part + lookup_last_part) - len(first_part + last_part)
+            print(f'crEnc lookup decoder costs {cost} B', file=sys.stderr)
+        first_part = lookup_first_part
+        last_part = lookup_last_part
     return first_part.encode() + encoded + last_part.encode('l1')  # Encode with l1 as I used explicit bytes above
@@ -0,0 +1,138 @@
+"""Decode time benchmark across encoder options
+
+The encoder options are usually chosen by output size alone, but the decode time on the client matters as well.
+This encodes a text with every combination of the given mtf, bitdepth and bin2txt options (and optionally progressive rendering),
+loads each variant several times in each browser, and tabulates the size against the decode times reported by the page.
+The variants are encoded with signal_done=True, which sets the done flag to the completion time (full decode).
+The first render is taken from the first-contentful-paint entry of the page, and precedes the full decode only with progressive rendering.
+Times are in ms from the navigation start, with the median over the runs.
+Pages are loaded from local files, so the times are dominated by script parsing and decoding, and not by the network.
+"""
+
+
+import argparse
+from contextlib import ExitStack
+from itertools import product
+import os
+from statistics import median
+import sys
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.remote.webdriver import WebDriver
+
+if not __package__:
+    import bwt_mtf, default_vars, deflate, validation, ztml
+else:
+    # noinspection PyPackages
+    from . import bwt_mtf, default_vars, deflate, validation, ztml
+
+
+default_runs = 5
+default_mtf_variants = [None, 0, 52, 80]
+max_paint_frames = 20  # The paint entry may only be reported a few frames after the completion signal
+headers = ['Configuration', 'Browser', 'Size (B)', 'First render (ms)', 'Full decode (ms)']
+
+
+def get_configs(mtf_variants: Iterable[Optional[int]] = default_mtf_variants,
+                bitdepths: Iterable[int] = deflate.allowed_bitdepths,
+                bin2txt_encodings: Iterable[str] = ztml.bin2txt_encodings,
+                progressive_modes: Iterable[bool] = (False,)
+                ) -> List[Dict[str, Any]]:
+    return [dict(mtf=mtf, bitdepth=bitdepth, bin2txt=bin2txt, progressive=progressive)
+            for mtf, bitdepth, bin2txt, progressive in product(mtf_variants, bitdepths, bin2txt_encodings, progressive_modes)]
+
+
+def get_label(config: Dict[str, Any]) -> str:
+    return ' '.join(f'{k}={v}' for k, v in config.items() if v is not False)
+
+
+def measure(browser: WebDriver,
+            filename: str,
+            timeout: int = validation.default_timeout,
+            done_var: str = default_vars.done
+            ) -> Tuple[Optional[float], Optional[float]]:
+    # First render and full decode of a single page load
+    browser.get(validation.full_path(filename))
+    browser.set_script_timeout(timeout)
+    try:
+        first_render, full_decode = browser.execute_async_script(f'''let done=arguments[0],n=0,f=()=>{{
+let p=performance.getEntriesByName('first-contentful-paint')[0]
+p||n++>{max_paint_frames}?done([p?p.startTime:null,self.{done_var}]):requestAnimationFrame(f)}},g=()=>self.{done_var}?f():setTimeout(g,{validation.done_poll_interval})
+g()''')
+    except TimeoutException:
+        return None, None
+    return first_render, full_decode
+
+
+def benchmark(data: str,
+              configs: Iterable[Dict[str, Any]],
+              browsers: Optional[Iterable[str]] = None,
+              runs: int = default_runs,
+              timeout: int = validation.default_timeout,
+              output_folder: str = '',  # Keep the variants here. A temporary folder by default
+              verbose: bool = True
+              ) -> List[Dict[str, Any]]:
+    if browsers is None:
+        browsers = list(validation.drivers)
+    rows = []
+    with ExitStack() as stack:
+        if output_folder:
+            os.makedirs(output_folder, exist_ok=True)
+        else:
+            output_folder = stack.enter_context(TemporaryDirectory())
+        variants = []
+        for i, config in enumerate(configs):
+            filename = os.path.join(output_folder, f'benchmark_{i}.html')
+            variants.append((config, filename, len(ztml.ztml(data, filename, signal_done=True, **config))))
+        for browser in browsers:
+            session = validation.get_browser(browser, stack)
+            for config, filename, size in variants:
+                times = [measure(session, filename, timeout) for _ in range(runs)]
+                first_render, full_decode = ([t[i] for t in times if t[i] is not None] for i in range(2))
+                row = dict(config=get_label(config), browser=browser, size=size,
+                           first_render=median(first_render) if first_render else None,
+                           full_decode=median(full_decode) if full_decode else None)
+                if verbose:
+                    print(' | '.join(format_row(row)), file=sys.stderr)
+                rows.append(row)
+    return rows
+
+
+def format_row(row: Dict[str, Any]) -> List[str]:
+    return [row['config'], row['browser'], f"{row['size']:,}"] + ['' if row[k] is None else f'{row[k]:.1f}' for k in ['first_render', 'full_decode']]
+
+
+def format_table(rows: Iterable[Dict[str, Any]]) -> str:
+    # Markdown table, sorted by browser and size
+    cells = [headers] + [format_row(row) for row in sorted(rows, key=lambda row: (row['browser'], row['size']))]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(headers))]
+    lines = ['| ' + ' | '.join(cell.ljust(width) for cell, width in zip(line, widths)) + ' |' for line in cells]
+    lines.insert(1, '|' + '|'.join('-' * (width + 2) for width in widths) + '|')
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_filename', help='utf8 text file')
+    parser.add_argument('output_filename', nargs='?', default='', help='Markdown table. Printed by default')
+    parser.add_argument('--browsers', type=str.lower, nargs='+', choices=list(validation.drivers), default=list(validation.drivers))
+    parser.add_argument('--mtf', type=lambda x: None if x.lower() == 'none' else int(x), nargs='+', choices=bwt_mtf.mtf_variants,
+                        default=default_mtf_variants)
+    parser.add_argument('--bitdepth', type=int, nargs='+', choices=deflate.allowed_bitdepths, default=deflate.allowed_bitdepths)
+    parser.add_argument('--bin2txt', type=str.lower, nargs='+', choices=ztml.bin2txt_encodings, default=ztml.bin2txt_encodings)
+    parser.add_argument('--progressive', action='store_true', help='Also benchmark progressive rendering, where the first render precedes the full decode')
+    parser.add_argument('--runs', type=int, default=default_runs, help='Page loads per variant and browser')
+    parser.add_argument('--timeout', type=int, default=validation.default_timeout, help='Per page load')
+    parser.add_argument('--output_folder', default='', help='Keep the variants here. A temporary folder by default')
+    args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+    with open(args.input_filename, encoding='utf8') as f:
+        data = f.read()
+    configs = get_configs(args.mtf, args.bitdepth, args.bin2txt, [False, True] if args.progressive else [False])
+    table = format_table(benchmark(data, configs, args.browsers, args.runs, args.timeout, args.output_folder))
+    if args.output_filename:
+        with open(args.output_filename, 'w', encoding='utf8') as f:
+            f.write(table)
+    else:
+        print(table, end='')
@@ -3,3 +3,8 @@ bwt_func = 'f'
 bytearray = 'o'
 image = 'i'
 text = 't'
+shared_decoder = 'ztml'
+worker = 'w'
+segments = 'g'
+timings = 'ztml_timings'
+done = 'ztml_done'
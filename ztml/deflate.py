@@ -46,23 +46,24 @@ import os
 import platform
 import sys
 from tempfile import NamedTemporaryFile
-from typing import List, Iterable, Optional
+from typing import List, Iterable, Optional, Tuple, Union
 
 import png
 # noinspection PyPackageRequirements
 import zopfli
 
 if not __package__:
-    import default_vars
+    import default_vars, webify
 else:
     # noinspection PyPackages
-    from . import default_vars
+    from . import default_vars, webify
 
 
 max_dim = 32767
 max_len = 11180 ** 2
 allowed_bitdepths = [1, 8, 24]  # Warning: 8-bit and 24-bit do not work on Safari
 default_bitdepth = 1
+iend_chunk = b'\0\0\0\0IEND\xaeB`\x82'
 
 
 def to_png(bits: Iterable[int],
@@ -112,49 +113,79 @@ def to_png(bits: Iterable[int],
                compression=compression).write(png_data, data)
     png_data.seek(0)
     png_data = png_data.read()
-    out = png_data
+    out = optimize_png(png_data, ect, ect_compression, ect_filters, zop_filters, zop_iterations, zop_iterations_large)
+    if omit_iend:  # Warning: do this only for PNG files
+        out = out[:-12]  # IEND length (4 bytes) + IEND tag (4 bytes) + IEND CRC-32 (4 bytes). Note: do not omit the IDAT zlib Adler-32 or the IDAT CRC-32 as this will break Safari
+    if verbose:
+        print(f'input_bits={bit_len} pad_bits={pad_bits} width={width} height={height} pad_pixels={pad_pixels} total_pad_bits={length*bitdepth - bit_len} bits={length * bitdepth} bytes={length*bitdepth+7 >> 3} png={len(png_data)} final={len(out)}', file=sys.stderr)
+    if filename:
+        with open(filename, 'wb') as f:
+            f.write(out)
+    return out
+
+
+encode = to_png
+
 
+def optimize_png(png_data: bytes,
+                 ect: bool = False,
+                 ect_compression: int = 20009,
+                 ect_filters: str = 'allfilters',
+                 zop_filters: str = '',
+                 zop_iterations: int = 15,
+                 zop_iterations_large: int = 5
+                 ) -> bytes:
+    # Recompress with ECT or Zopfli. Time-consuming op.
     if ect:
         with NamedTemporaryFile(suffix='.png', delete=False) as f:  # See https://github.com/python/cpython/issues/88221
-            f.write(out)
+            f.write(png_data)
             filename = f.name
         ect_filters_arg = f'--{ect_filters}' * bool(ect_filters)
         ect_path = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'ect', 'ect')) + '-ubuntu' * (platform.system() == 'Linux')
-        error = os.system(f'{ect_path} -{ect_compression} -strip -quiet --strict {ect_filters_arg} --mt-deflate {filename}')  # Time-consuming op.
+        error = os.system(f'{ect_path} -{ect_compression} -strip -quiet --strict {ect_filters_arg} --mt-deflate {filename}')
         assert not error, f'Error: could not run {ect_path} - Please install from https://github.com/fhanau/Efficient-Compression-Tool or use ect=False'
         with open(filename, 'rb') as f:
-            out = f.read()
+            png_data = f.read()
         try:
             os.remove(filename)
         except PermissionError:
             pass
     elif zop_iterations > 0 and zop_iterations_large > 0:
-        out = zopfli.ZopfliPNG(filter_strategies=zop_filters,
-                               iterations=zop_iterations,
-                               iterations_large=zop_iterations_large
-                               ).optimize(png_data)  # Time-consuming op.
-    if omit_iend:  # Warning: do this only for PNG files
-        out = out[:-12]  # IEND length (4 bytes) + IEND tag (4 bytes) + IEND CRC-32 (4 bytes). Note: do not omit the IDAT zlib Adler-32 or the IDAT CRC-32 as this will break Safari
-    if verbose:
-        print(f'input_bits={bit_len} pad_bits={pad_bits} width={width} height={height} pad_pixels={pad_pixels} total_pad_bits={length*bitdepth - bit_len} bits={length * bitdepth} bytes={length*bitdepth+7 >> 3} png={len(png_data)} final={len(out)}', file=sys.stderr)
-    if filename:
-        with open(filename, 'wb') as f:
-            f.write(out)
-    return out
+        png_data = zopfli.ZopfliPNG(filter_strategies=zop_filters,
+                                    iterations=zop_iterations,
+                                    iterations_large=zop_iterations_large
+                                    ).optimize(png_data)
+    return png_data
 
 
-encode = to_png
+def get_png_reader(file: Union[str, bytes]) -> png.Reader:
+    # From a filename or from the PNG bytes, which may omit the IEND chunk as in to_png()
+    if isinstance(file, str):
+        with open(file, 'rb') as f:
+            file = f.read()
+    if not file.endswith(iend_chunk):
+        file += iend_chunk
+    return png.Reader(bytes=file)
+
 
+def load_png(file: Union[str, bytes]) -> List[int]:
+    return get_png_reader(file).read_flat()[2].tolist()
 
-def load_png(filename: str) -> List[int]:
-    return png.Reader(filename=filename).read_flat()[2].tolist()
+
+def load_png_rgba(file: Union[str, bytes]) -> Tuple[int, int, bytes]:
+    # Width, height and RGBA pixels, as read back from a canvas
+    width, height, rows, _ = get_png_reader(file).asRGBA8()
+    return width, height, b''.join(map(bytes, rows))
 
 
 def get_js_create_image(image_var: str = default_vars.image,
-                        bytearray_var: str = default_vars.bytearray
+                        bytearray_var: str = default_vars.bytearray,
+                        url: str = '',  # Load from a separate PNG file instead of the decoded bytes. Warning: this requires serving over HTTP (file:// taints the canvas)
+                        timing: bool = False
                         ) -> str:
-    return f'''{image_var}=new Image
-{image_var}.src=URL.createObjectURL(new Blob([{bytearray_var}]))
+    src = f"'{url}'" if url else f'URL.createObjectURL(new Blob([{bytearray_var}]))'
+    return f'''{webify.get_js_mark('image') * timing}{image_var}=new Image
+{image_var}.src={src}
 '''
 
 
@@ -162,24 +193,33 @@ def get_js_image_data(bit_len: int,
                       decoder_script: str = '',
                       bitdepth: int = default_bitdepth,
                       image_var: str = default_vars.image,
-                      bitarray_var: str = default_vars.bitarray
+                      bitarray_var: str = default_vars.bitarray,
+                      timing: bool = False  # Measure the image decoding, from the image mark, and the canvas readback
                       ) -> str:
     assert bitdepth in allowed_bitdepths, f'Error: bitdepth={bitdepth} not in {allowed_bitdepths}'
     js_image_data = f'''{image_var}.decode().then(c=>{{
-c=document.createElement`canvas`
+{(webify.get_js_measure('image') + webify.get_js_mark('canvas')) * timing}c=document.createElement`canvas`
 x=c.getContext`2d`
 c=[c.width={image_var}.width,c.height={image_var}.height]
 x.drawImage({image_var},0,0)
 s=x.getImageData({bitarray_var}=[],0,...c).data{'.filter((v,i)=>(i+1)%4)' * (bitdepth == 24)}
 '''
+    js_image_data += get_js_pixels_to_bits(bit_len, bitdepth, bitarray_var)
+    js_image_data += webify.get_js_measure('canvas') * timing
+    js_image_data += f'{decoder_script.strip()}}})'
+    return js_image_data
+
+
+def get_js_pixels_to_bits(bit_len: int,
+                          bitdepth: int = default_bitdepth,
+                          bitarray_var: str = default_vars.bitarray
+                          ) -> str:
     if bitdepth == 1:
-        js_image_data += f'for(j={bit_len};j--;){bitarray_var}[j]=s[j*4]>>7&1\n'  # Applying >>7 to deal with Safari PNG rendering inaccuracy
-    else:  # Will break Safari
-        js_image_data += f'''for(j={(bit_len+(bitdepth-bit_len)%bitdepth) // 8};j--;)for(k=8;k--;){bitarray_var}[j*8+k]=s[j{'*4' * (bitdepth <= 8)}]>>7-k&1
+        return f'for(j={bit_len};j--;){bitarray_var}[j]=s[j*4]>>7&1\n'  # Applying >>7 to deal with Safari PNG rendering inaccuracy
+    # Will break Safari
+    return f'''for(j={(bit_len+(bitdepth-bit_len)%bitdepth) // 8};j--;)for(k=8;k--;){bitarray_var}[j*8+k]=s[j{'*4' * (bitdepth <= 8)}]>>7-k&1
 {bitarray_var}.length={bit_len}
 '''
-    js_image_data += f'{decoder_script.strip()}}})'
-    return js_image_data
 
 
 def get_js_image_decoder(bit_len: int,
@@ -187,7 +227,51 @@ def get_js_image_decoder(bit_len: int,
                          bitdepth: int = default_bitdepth,
                          image_var: str = default_vars.image,
                          bytearray_var: str = default_vars.bytearray,
-                         bitarray_var: str = default_vars.bitarray
+                         bitarray_var: str = default_vars.bitarray,
+                         url: str = '',
+                         timing: bool = False
                          ) -> str:
-    return get_js_create_image(image_var, bytearray_var) + get_js_image_data(
-        bit_len, decoder_script, bitdepth, image_var, bitarray_var)
+    return get_js_create_image(image_var, bytearray_var, url, timing) + get_js_image_data(
+        bit_len, decoder_script, bitdepth, image_var, bitarray_var, timing)
+
+
+def get_js_worker_script(bit_len: int,
+                         decoder_script: str = '',
+                         bitdepth: int = default_bitdepth,
+                         bitarray_var: str = default_vars.bitarray,
+                         result_var: str = default_vars.text,
+                         timing: bool = False,  # The stage timings of the decoder script are collected in the worker and posted back with the result
+                         timings_var: str = default_vars.timings
+                         ) -> str:
+    # Worker code receiving the PNG as a Blob, reading the pixels with createImageBitmap and OffscreenCanvas,
+    # running the decoder script, and posting back the result
+    assert bitdepth in allowed_bitdepths, f'Error: bitdepth={bitdepth} not in {allowed_bitdepths}'
+    return f'''{f'{timings_var}={{}}' * timing}
+onmessage=async e=>{{
+c=await createImageBitmap(e.data)
+x=new OffscreenCanvas(c.width,c.height).getContext`2d`
+x.drawImage(c,0,0)
+s=x.getImageData({bitarray_var}=[],0,c.width,c.height).data{'.filter((v,i)=>(i+1)%4)' * (bitdepth == 24)}
+{get_js_pixels_to_bits(bit_len, bitdepth, bitarray_var)}{decoder_script.strip()}
+postMessage({f'[{result_var},{timings_var}]' if timing else result_var})}}
+'''
+
+
+def get_js_worker_decoder(worker_script: str,
+                          main_script: str = '',
+                          bytearray_var: str = default_vars.bytearray,
+                          result_var: str = default_vars.text,
+                          worker_var: str = default_vars.worker,
+                          url: str = '',  # Fetch the PNG from this URL instead of using the decoded bytes
+                          timing: bool = False,  # Measure the whole round trip, and add the stage timings posted back by the worker script
+                          timings_var: str = default_vars.timings
+                          ) -> str:
+    # Run the worker script from a Blob URL, so that decoding does not block the main thread,
+    # and then run the main script with the result. The worker script is kept in a template literal, so that it is not aliased together with the main script
+    post = f"fetch('{url}').then(r=>r.blob()).then(r=>{worker_var}.postMessage(r))" if url else f'{worker_var}.postMessage(new Blob([{bytearray_var}]))'
+    receive = f'[{result_var},e]=e.data\nfor(k in e){timings_var}[k]=({timings_var}[k]||0)+e[k]' if timing else f'{result_var}=e.data'  # Workers have their own globals
+    return f'''{worker_var}=new Worker(URL.createObjectURL(new Blob([`{webify.escape(worker_script.strip())}`])))
+{worker_var}.onmessage=e=>{{{receive}
+{webify.get_js_measure('worker') * timing}{main_script.strip()}}}
+{webify.get_js_mark('worker') * timing}{post}
+'''
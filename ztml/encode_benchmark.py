@@ -0,0 +1,258 @@
+"""Reproducible encoding benchmark with per-stage timing and size
+
+Runs ztml() on a fixed corpus and on seeded synthetic texts (Latin, Hebrew, CJK, emoji-heavy, highly repetitive and random),
+at several sizes, and records the wall time, peak memory and output bytes of every pipeline stage,
+by wrapping the stage functions for the duration of the run.
+Stage times are exclusive of nested stages, e.g. the PNG stage excludes the Zopfli/ECT recompression,
+and the minimum over repeated runs is reported.
+Peak memory is measured with tracemalloc, in a separate run as tracing slows down execution,
+and only covers allocations traced by Python and numpy (e.g. not in pydivsufsort or ECT), including nested stages.
+Stage output bytes are the UTF-8 size of text outputs, and the packed size of bit outputs.
+The corpus consists of frozen copies of files of this repo (misc/encode_corpus), so that the inputs do not change with the code,
+and the SHA-256 digests of the corpus files are recorded with the results, which are emitted as JSON.
+"""
+
+
+import argparse
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from hashlib import sha256
+import json
+import os
+import platform
+import random
+import sys
+from time import perf_counter
+import tracemalloc
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+if not __package__:
+    import base125, base139, bwt_mtf, crenc, deflate, dictionary, huffman, text_prep, webify, ztml
+else:
+    # noinspection PyPackages
+    from . import base125, base139, bwt_mtf, crenc, deflate, dictionary, huffman, text_prep, webify, ztml
+
+
+corpus_folder = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'misc', 'encode_corpus'))
+default_corpus = [os.path.join(corpus_folder, filename) for filename in ['LICENSE.txt', 'README.md.txt', 'ztml.py.txt']]
+default_sizes = [1000, 10000, 100000]
+default_seed = 0
+default_repeat = 3
+vocabulary_size = 2000
+stages = dict(text_prep=[(text_prep, 'encode_and_get_js_decoder')],
+              dictionary=[(dictionary, 'encode_and_get_js_decoder')],
+              bwt_mtf=[(bwt_mtf, 'encode_and_get_js_decoder')],  # Reported as bwt_bits when called on bits
+              huffman=[(huffman, 'encode_and_get_js_decoder')],
+              png=[(deflate, 'to_png')],
+              zopfli_ect=[(deflate, 'optimize_png')],
+              bin2txt=[(base125, 'get_js_decoder'), (base139, 'get_js_decoder'), (crenc, 'get_js_decoder')],
+              minify=[(webify, 'minify')],
+              uglify=[(webify, 'uglify')],
+              pack=[(webify, 'pack')])
+
+
+def get_size(out: Any) -> int:
+    if isinstance(out, tuple):  # (encoded, js_decoder)
+        out = out[0]
+    if isinstance(out, str):
+        return len(out.encode(errors='surrogatepass'))
+    if isinstance(out, bytes):
+        return len(out)
+    return len(out) + 7 >> 3  # Bits
+
+
+@contextmanager
+def record_stages(memory: bool = False) -> Iterator[Tuple[Dict[str, Dict[str, float]], Dict[str, float]]]:
+    # Accumulate per stage: calls, exclusive time (sec), peak traced memory (bytes) and output bytes.
+    # Also yields the root frame, which has the overall peak memory after exiting
+    records = defaultdict(lambda: dict(calls=0, time=0.0, peak_memory=0, output_bytes=0))
+    root = dict(start_memory=0, peak=0, nested_time=0.0, peak_memory=0)
+    frames = [root]
+
+    def wrap(stage: str, func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            name = 'bwt_bits' if stage == 'bwt_mtf' and not isinstance(args[0], str) else stage
+            if memory:
+                frames[-1]['peak'] = max(frames[-1]['peak'], tracemalloc.get_traced_memory()[1])
+                tracemalloc.reset_peak()
+            frame = dict(start_memory=tracemalloc.get_traced_memory()[0] if memory else 0, peak=0, nested_time=0.0)
+            frames.append(frame)
+            start_time = perf_counter()
+            try:
+                out = func(*args, **kwargs)
+            finally:
+                duration = perf_counter() - start_time
+                frames.pop()
+                frames[-1]['nested_time'] += duration
+            record = records[name]
+            record['calls'] += 1
+            record['time'] += duration - frame['nested_time']
+            record['output_bytes'] += get_size(out)
+            if memory:
+                frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                record['peak_memory'] = max(record['peak_memory'], frame['peak'] - frame['start_memory'])
+                frames[-1]['peak'] = max(frames[-1]['peak'], frame['peak'])
+            return out
+        return wrapper
+
+    originals = [(module, attr, getattr(module, attr)) for targets in stages.values() for module, attr in targets]
+    for stage, targets in stages.items():
+        for module, attr in targets:
+            setattr(module, attr, wrap(stage, getattr(module, attr)))
+    if memory:
+        tracemalloc.start()
+        root['start_memory'] = root['peak'] = tracemalloc.get_traced_memory()[0]
+    try:
+        yield records, root
+    finally:
+        if memory:
+            root['peak_memory'] = max(root['peak'], tracemalloc.get_traced_memory()[1]) - root['start_memory']
+            tracemalloc.stop()
+        for module, attr, func in originals:
+            setattr(module, attr, func)
+
+
+def generate_words(alphabet: str, size: int, seed: int = default_seed, emoji_ratio: float = 0) -> str:
+    # Sentences of Zipf distributed words from a random vocabulary
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choices(alphabet, k=rng.randint(1, 10))) for _ in range(vocabulary_size)]
+    weights = [1 / rank for rank in range(1, vocabulary_size + 1)]
+    emojis = [chr(c) for c in range(0x1f600, 0x1f650)]
+    out = []
+    length = 0
+    while length < size:
+        words = rng.choices(vocabulary, weights, k=rng.randint(3, 20))
+        if emoji_ratio:
+            words = [rng.choice(emojis) if rng.random() < emoji_ratio else word for word in words]
+        sentence = ' '.join(words) + rng.choice('.....?!') + rng.choice('    \n')
+        out.append(sentence[0].upper() + sentence[1:])
+        length += len(sentence)
+    return ''.join(out)[:size]
+
+
+def generate_cjk(size: int, seed: int = default_seed) -> str:
+    rng = random.Random(seed)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + vocabulary_size)]
+    weights = [1 / rank for rank in range(1, vocabulary_size + 1)]
+    out = rng.choices(chars, weights, k=size)
+    for i in range(rng.randint(5, 30), size, 20):
+        out[i] = rng.choice('，，，。。！？\n')
+    return ''.join(out)
+
+
+generators = dict(latin=lambda size, seed: generate_words('abcdefghijklmnopqrstuvwxyz', size, seed),
+                  hebrew=lambda size, seed: generate_words(''.join(chr(c) for c in range(0x5d0, 0x5eb)), size, seed),
+                  cjk=generate_cjk,
+                  emoji=lambda size, seed: generate_words('abcdefghijklmnopqrstuvwxyz', size, seed, emoji_ratio=0.3),
+                  repetitive=lambda size, seed: ('All work and no play makes Jack a dull boy.\n' * (size // 44 + 1))[:size],
+                  random=lambda size, seed: ''.join(random.Random(seed).choices([chr(c) for c in range(32, 127)] + ['\n'], k=size)))
+
+
+def get_corpus_digests(corpus: List[str] = default_corpus) -> Dict[str, str]:
+    digests = {}
+    for filename in corpus:
+        with open(filename, 'rb') as f:
+            digests[os.path.basename(filename)] = sha256(f.read()).hexdigest()
+    return digests
+
+
+def get_inputs(corpus: List[str] = default_corpus,
+               generator_names: Optional[List[str]] = None,
+               sizes: List[int] = default_sizes,
+               seed: int = default_seed
+               ) -> Iterator[Tuple[str, str]]:
+    # Corpus files are truncated to each size, and sizes longer than the file are skipped
+    if generator_names is None:
+        generator_names = list(generators)
+    for size in sizes:
+        for filename in corpus:
+            with open(filename, encoding='utf8') as f:
+                text = f.read()
+            if len(text) >= size:
+                yield os.path.basename(filename), text[:size]
+        for name in generator_names:
+            yield name, generators[name](size, seed)
+
+
+def benchmark_text(data: str, repeat: int = default_repeat, memory: bool = True, **kwargs) -> Dict[str, Any]:
+    runs = []
+    for i in range(repeat + memory):
+        traced = memory and i == repeat  # Last, so that its overhead does not affect the timed runs
+        with record_stages(traced) as (records, root):
+            start_time = perf_counter()
+            out = ztml.ztml(data, **kwargs)
+            duration = perf_counter() - start_time
+        runs.append((traced, duration, root['peak_memory'], len(out), dict(records)))
+    timed = [run for run in runs if not run[0]]
+    best = min(timed, key=lambda run: run[1])
+    result = dict(chars=len(data), input_bytes=len(data.encode(errors='surrogatepass')), output_bytes=best[3],
+                  time=best[1], stages={name: dict(record) for name, record in best[4].items()})
+    for name, stage in result['stages'].items():
+        stage['time'] = min(run[4][name]['time'] for run in timed)
+    if memory:
+        result['peak_memory'] = runs[-1][2]
+        for name, stage in result['stages'].items():
+            stage['peak_memory'] = runs[-1][4][name]['peak_memory']
+    else:
+        for stage in result['stages'].values():
+            del stage['peak_memory']
+    return result
+
+
+def benchmark(corpus: List[str] = default_corpus,
+              generator_names: Optional[List[str]] = None,
+              sizes: List[int] = default_sizes,
+              seed: int = default_seed,
+              repeat: int = default_repeat,
+              memory: bool = True,
+              verbose: bool = True,
+              **kwargs
+              ) -> Dict[str, Any]:
+    results = []
+    for name, data in get_inputs(corpus, generator_names, sizes, seed):
+        result = dict(input=name, **benchmark_text(data, repeat, memory, **kwargs))
+        if verbose:
+            print(f"{name} chars={result['chars']:,} output={result['output_bytes']:,} B time={result['time']:.2f} sec. "
+                  + ' '.join(f"{stage}={record['time']:.2f}" for stage, record in result['stages'].items()), file=sys.stderr)
+        results.append(result)
+    return dict(python=sys.version.split()[0], platform=platform.platform(), corpus=get_corpus_digests(corpus), seed=seed, repeat=repeat,
+                options=kwargs, results=results)
+
+
+def test() -> None:
+    for name, generator in generators.items():
+        text = generator(500, default_seed)
+        assert len(text) == 500 and text == generator(500, default_seed), name
+    result = benchmark_text(generators['emoji'](2000, default_seed), repeat=1)
+    assert {'text_prep', 'bwt_mtf', 'huffman', 'bwt_bits', 'png', 'zopfli_ect', 'bin2txt', 'uglify'} <= set(result['stages']), result['stages']
+    assert all(stage['time'] >= 0 and stage['output_bytes'] > 0 and stage['peak_memory'] > 0 for stage in result['stages'].values())
+    assert result['time'] >= sum(stage['time'] for stage in result['stages'].values())
+    results = benchmark(generator_names=[], sizes=[1000], repeat=1, memory=False, verbose=False)
+    assert list(results['corpus']) == [os.path.basename(filename) for filename in default_corpus] and len(results['results']) == len(default_corpus), results['corpus']
+    assert bwt_mtf.encode_and_get_js_decoder.__name__ == 'encode_and_get_js_decoder' and not hasattr(bwt_mtf.encode_and_get_js_decoder, '__wrapped__')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_filename', nargs='?', default='', help='JSON. Printed by default')
+    parser.add_argument('--corpus', nargs='*', default=default_corpus, help='utf8 text files. Defaults to the frozen copies of files of this repo')
+    parser.add_argument('--generators', type=str.lower, nargs='*', choices=list(generators), default=list(generators))
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help='In characters')
+    parser.add_argument('--seed', type=int, default=default_seed)
+    parser.add_argument('--repeat', type=int, default=default_repeat, help='Timed runs, reporting the minimum')
+    parser.add_argument('--skip_memory', action='store_true', help='Skip the traced run for peak memory')
+    parser.add_argument('--mtf', type=lambda x: None if x.lower() == 'none' else int(x), choices=bwt_mtf.mtf_variants, default=bwt_mtf.default_mtf)
+    parser.add_argument('--bitdepth', type=int, choices=deflate.allowed_bitdepths, default=deflate.default_bitdepth)
+    parser.add_argument('--ect', action='store_true')
+    parser.add_argument('--bin2txt', type=str.lower, choices=ztml.bin2txt_encodings, default=ztml.default_bin2txt)
+    args = parser.parse_args()
+    results = benchmark(args.corpus, args.generators, args.sizes, args.seed, args.repeat, not args.skip_memory,
+                        mtf=args.mtf, bitdepth=args.bitdepth, ect=args.ect, bin2txt=args.bin2txt)
+    out = json.dumps(results, indent=2)
+    if args.output_filename:
+        with open(args.output_filename, 'w', encoding='utf8') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
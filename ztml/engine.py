@@ -0,0 +1,256 @@
+"""Validation by running the generated JS in an embedded engine
+
+Runs the outputs in QuickJS (via the optional quickjs package), instead of in a browser.
+A minimal shim provides what the generated decoders use: document.body, createElement, write,
+Image, canvas drawImage and getImageData, Blob and object URLs, fetch, Worker, createImageBitmap,
+OffscreenCanvas, timers, events and performance marks.
+The images are decoded in Python, and handed to the canvas as RGBA pixels, so this checks the emitted JS itself
+(packing, uglification, bin2txt, pixel readback and all the decoding stages), but not the browser PNG decoding or rendering.
+The rendered text is then read from the body or from an element by id, or from text_var with raw=True,
+and image outputs from their data URL or from bytearray_var.
+This runs without a browser, and is much faster than Selenium for validating large test matrices.
+Workers run in their own context, and the messages and timers are dispatched in a simple event loop.
+Shared decoders and sidecar PNGs are read from the folder of the output.
+"""
+
+
+from base64 import b64decode
+import json
+import os
+from random import Random
+from time import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import unquote_to_bytes
+
+try:
+    import quickjs
+except ImportError:  # Only needed for browser='quickjs'
+    quickjs = None
+
+if not __package__:
+    import default_vars, deflate, reference
+else:
+    # noinspection PyPackages
+    from . import default_vars, deflate, reference
+
+
+browser_name = 'quickjs'  # Pseudo browser for validation.render_html(), validation.validate_files() and ztml(validate=True)
+default_timeout = 60
+
+
+# Binary data is passed between JS and Python as latin1 strings, and strings are passed as JSON, as they would otherwise be truncated at NUL.
+# Python callables cannot be combined with the QuickJS time limit, so the timeout is only checked between tasks
+shim = r'''self=globalThis
+__tasks=[];__listeners={};__blobs=[];__workers=[];__marks={};__errors=[];__start=Date.now()
+{let then=Promise.prototype.then;Promise.prototype.then=function(f,r){return then.call(this,f&&((...a)=>{try{return f(...a)}catch(e){__errors.push(e);throw e}}),r)}}
+__latin1=a=>{let s='';for(let i=0;i<a.length;i+=8192)s+=String.fromCharCode.apply(null,Array.prototype.slice.call(a,i,i+8192));return s}
+class Blob{constructor(parts=[]){this._data=parts.map(p=>p instanceof Blob?p._data:typeof p=='string'?unescape(encodeURIComponent(p)):__latin1(new Uint8Array(p.buffer||p,p.byteOffset||0,p.byteLength))).join('')}
+get size(){return this._data.length}
+text(){return Promise.resolve(decodeURIComponent(escape(this._data)))}}
+__blob=d=>Object.assign(new Blob,{_data:d})
+URL={createObjectURL:b=>'blob:'+(__blobs.push(b)-1),revokeObjectURL(){}}
+__call=(f,...a)=>JSON.parse(f(...a.map(x=>JSON.stringify(x))))
+__load=u=>(u=String(u)).startsWith('blob:')?__blobs[u.slice(5)]._data:__call(__read,u)
+__image=d=>{let[width,height,s]=__call(__png,d),p=new Uint8ClampedArray(s.length)
+for(let k=p.length;k--;)p[k]=s.charCodeAt(k)
+return{width,height,_pixels:p}}
+class Element{constructor(tag){this.tagName=String(tag).toUpperCase();this.childNodes=[];this.style={};this.src=''}
+appendChild(c){this.childNodes.push(c);return c}
+append(...a){for(let c of a)this.childNodes.push(c instanceof Element?c:{textContent:String(c)})}
+get textContent(){return this.childNodes.map(c=>c.textContent).join('')}
+set textContent(v){this.childNodes=[{textContent:String(v)}]}
+get innerText(){return this.textContent}
+set innerHTML(v){this.textContent=v}
+get id(){return this._id||''}
+set id(v){this._id=v;self[v]=this}
+setAttribute(k,v){k=='style'?this.style.cssText=v:this[k]=v}
+addEventListener(){}
+find(tag){for(let c of this.childNodes)if(c instanceof Element&&(c.tagName==tag||(c=c.find(tag))))return c}}
+class Image extends Element{constructor(){super('img')}
+decode(){return Promise.resolve().then(()=>{Object.assign(this,__image(__load(this.src)))})}}
+class Canvas extends Element{constructor(w=300,h=150){super('canvas');this.width=w;this.height=h}
+getContext(){let c=this;return{canvas:c,drawImage(i){c._pixels=i._pixels},getImageData(x,y,w,h){return{width:w,height:h,data:c._pixels}}}}}
+OffscreenCanvas=Canvas
+createImageBitmap=b=>Promise.resolve().then(()=>__image(b._data))
+document={body:new Element('body'),_written:'',createElement:e=>String(e).toLowerCase()=='canvas'?new Canvas:new Element(e),
+write:(...a)=>{document._written+=a.join('')},close(){},getElementById:i=>self[i]}
+fetch=u=>Promise.resolve().then(()=>({blob:()=>Promise.resolve(__blob(__load(u)))}))
+setTimeout=requestIdleCallback=(f,...a)=>typeof f=='function'&&__tasks.push(()=>f(...a))
+clearTimeout=cancelIdleCallback=()=>{}
+class Event{constructor(t){this.type=String(t)}}
+addEventListener=(t,f)=>(__listeners[t]=__listeners[t]||[]).push(f)
+dispatchEvent=e=>{(__listeners[e.type]||[]).map(f=>f(e));return true}
+performance={now:()=>Date.now()-__start,mark:n=>{__marks[n]=performance.now()},measure:(n,s)=>({name:n,duration:performance.now()-(__marks[s]||0)})}
+__pack=d=>d instanceof Blob?['blob',d._data]:['data',d]
+__deliver=(id,[kind,data])=>{data=kind=='blob'?__blob(data):data;let t=id<0?self:__workers[id];__tasks.push(()=>t.onmessage&&t.onmessage({data}))}
+class Worker{constructor(u){this.id=__call(__spawn,decodeURIComponent(escape(__load(u))));__workers[this.id]=this}
+postMessage(d){__call(__post,this.id,__pack(d))}
+terminate(){}}
+postMessage=d=>__call(__post,-1,__pack(d))
+__tick=()=>{let f=__tasks.shift();f&&f();return!!f}
+'''
+
+
+def read_url(url: str, base_dir: str) -> str:
+    if url.startswith('data:'):
+        header, payload = url[5:].split(',', 1)
+        data = b64decode(payload) if header.endswith(';base64') else unquote_to_bytes(payload)
+    else:
+        assert not url.startswith(('http://', 'https://')), f'Error: {browser_name} cannot load {url}'
+        data = reference.read_sibling(url, base_dir)
+    return data.decode('l1')
+
+
+def decode_png(data: str) -> Tuple[int, int, str]:
+    width, height, pixels = deflate.load_png_rgba(data.encode('l1'))
+    return width, height, pixels.decode('l1')
+
+
+def add_callable(context: 'quickjs.Context', name: str, func: Callable) -> None:
+    # Called from JS with __call()
+    context.add_callable(name, lambda *args: json.dumps(func(*map(json.loads, args)), ensure_ascii=False))
+
+
+class Page:
+    # A document context with its workers, sharing a single message queue
+    def __init__(self, base_dir: str = '', timeout: int = default_timeout) -> None:
+        assert quickjs is not None, f'Error: browser={browser_name} requires the quickjs package'
+        self.base_dir = base_dir
+        self.timeout = timeout
+        self.contexts: List['quickjs.Context'] = []
+        self.messages: List[Tuple[int, int, Union[str, list]]] = []
+        self.window = self.new_context()
+
+    def new_context(self) -> 'quickjs.Context':
+        context = quickjs.Context()
+        index = len(self.contexts)
+        self.contexts.append(context)
+        add_callable(context, '__read', lambda url: read_url(url, self.base_dir))
+        add_callable(context, '__png', decode_png)
+        add_callable(context, '__spawn', self.spawn)
+        add_callable(context, '__post', lambda target, message: self.messages.append(
+            (0, index - 1, message) if target < 0 else (target + 1, -1, message)))
+        context.eval(shim)
+        return context
+
+    def spawn(self, script: str) -> int:
+        worker = self.new_context()
+        worker.eval('document=undefined')  # Workers have no DOM
+        self.messages.append((len(self.contexts) - 1, -2, script))
+        return len(self.contexts) - 2
+
+    def run(self, script: str) -> None:
+        # Run the script, and then the microtasks, messages and timers, until idle
+        self.window.eval(script)
+        deadline = time() + self.timeout
+        busy = True
+        while busy:
+            assert time() < deadline, f'Error: {browser_name} timed out'
+            busy = False
+            for context in self.contexts:
+                while context.execute_pending_job():
+                    busy = True
+            while self.messages:
+                index, source, message = self.messages.pop(0)
+                context = self.contexts[index]
+                if isinstance(message, str):  # The script of a new worker
+                    context.eval(message)
+                else:
+                    context.set('__message', json.dumps(message))
+                    context.eval(f'__deliver({source},JSON.parse(__message))')
+                busy = True
+            for context in self.contexts:
+                busy |= context.eval('__tick()')
+        for context in self.contexts:
+            context.eval('if(__errors.length)throw __errors[0]')  # Errors in promise callbacks would otherwise be swallowed
+
+    def eval(self, expression: str) -> Any:
+        return json.loads(self.window.eval(f'JSON.stringify({expression})??"null"'))
+
+
+def render_html(file: Union[str, bytes],
+                by: str = 'tag name',  # Only 'tag name' and 'id' are supported, as in selenium.webdriver.common.by.By
+                element: str = 'body',
+                raw: bool = False,
+                image: bool = False,
+                timeout: int = default_timeout,
+                content_var: str = '',
+                timing: bool = False,
+                done_var: str = '',
+                base_dir: str = '',
+                js: bool = False,
+                encoding: str = ''
+                ) -> Union[Optional[Union[str, bytes]], Tuple[Optional[Union[str, bytes]], Dict[str, float]]]:
+    assert not raw or not image
+    assert by in ['tag name', 'id'], f'Error: browser={browser_name} does not support by={by}'
+    if isinstance(file, str):
+        assert not file.startswith(('http://', 'https://')), f'Error: browser={browser_name} only supports local files'
+        base_dir = os.path.dirname(file)
+        js = os.path.splitext(file)[-1].lower() == '.js'
+        with open(file, 'rb') as f:
+            file = f.read()
+    script, src, charset = reference.get_script(file, js, encoding)
+    page = Page(base_dir, timeout)
+    try:
+        if src:
+            page.run(reference.decode_html(reference.read_sibling(src, base_dir), charset))
+        page.run(script)
+    except AssertionError as e:
+        if 'timed out' not in str(e):
+            raise
+        return (None, {}) if timing else None
+    if done_var and not page.eval(f'!!self.{done_var}'):
+        return (None, {}) if timing else None
+    target = f"document.getElementById('{element}')" if by == 'id' else 'document.body' if element.lower() == 'body' else f"document.body.find('{element.upper()}')"
+    if image:
+        data_url = page.eval(f"(e=>e.style.background?e.style.background.slice(4,e.style.background.lastIndexOf(')')):e.src)({target})")
+        if ';base64,' in data_url:
+            rendered = b64decode(data_url.split(';base64,', 1)[1].strip('\'"'), validate=True)
+        else:
+            rendered = page.eval(f'__latin1({content_var or default_vars.bytearray})').encode('l1')
+    elif raw:
+        rendered = page.eval(f'{content_var or default_vars.text}')
+    else:
+        rendered = page.eval(f'{target}.innerText')
+    if timing:
+        return rendered, json.loads(page.eval(f'JSON.stringify(self.{default_vars.timings}||{{}})'))
+    return rendered
+
+
+def test() -> None:
+    if not __package__:
+        import text_prep, ztml
+    else:
+        # noinspection PyPackages
+        from . import text_prep, ztml
+    texts = ['Hello world!\n\nThe quick brown fox. I said: "Quit the queue".\n', 'שלום עולם 😀 \x00\r\n' * 20]
+    options = [{}, dict(bin2txt='base125'), dict(bin2txt='base139'), dict(bin2txt='base64'), dict(crenc_lookup=True),
+               dict(caps='raw', mtf=None, bwtsort=False), dict(caps='simple', mtf=52), dict(bitdepth=24, uglify=False, pack=False),
+               dict(js=True), dict(raw=True), dict(element_id='z'), dict(worker=True), dict(worker=True, bin2txt='base64'),
+               dict(fused_text_decoder=True, timing=True), dict(dict_words=16), dict(signal_done=True)]
+    for text in texts:
+        data = text_prep.get_expected(text_prep.normalize(text), text_prep.default_caps)
+        for kwargs in options:
+            out = ztml.ztml(text, **kwargs)
+            by = 'id' if kwargs.get('element_id') else 'tag name'
+            rendered = render_html(out, by, kwargs.get('element_id', 'body'), raw=kwargs.get('raw', False), js=kwargs.get('js', False),
+                                   done_var=default_vars.done * kwargs.get('signal_done', False))
+            expected = text_prep.get_expected(text_prep.normalize(text), kwargs['caps']) if 'caps' in kwargs else data
+            assert rendered == expected, (kwargs, rendered[:100])
+    rendered, timings = render_html(ztml.ztml(texts[0], worker=True, timing=True), timing=True)  # The worker stages are posted back to the main thread
+    assert rendered == text_prep.get_expected(text_prep.normalize(texts[0]), text_prep.default_caps) and {'worker', 'huffman', 'text_prep', 'render'} <= set(timings), (rendered[:100], timings)
+    rng = Random(0)
+    words = ['extraordinary', 'comprehension', 'international', 'responsibility', 'neighbourhood', 'sophisticated',
+             'understanding', 'circumstances', 'consciousness', 'acknowledgment', 'philosophical', 'unfortunately']
+    text = ' '.join(rng.choice(words) for _ in range(600))  # Long words in random order, where the dictionary makes the output smaller
+    out = ztml.ztml(text, dict_words=16)
+    assert len(out) < len(ztml.ztml(text)) and render_html(out) == text_prep.get_expected(text_prep.normalize(text), text_prep.default_caps)
+    image = deflate.to_png([1, 0, 1, 1, 0, 0, 1, 0] * 100, omit_iend=False)
+    for kwargs in [{}, dict(element_id='z'), dict(bin2txt='base64')]:
+        out = ztml.ztml(image, image=True, **kwargs)
+        by = 'id' if kwargs.get('element_id') else 'tag name'
+        assert render_html(out, by, kwargs.get('element_id', 'body'), image=True) == image, kwargs
+
+
+if __name__ == '__main__':
+    test()
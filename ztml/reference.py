@@ -0,0 +1,379 @@
+"""Pure-Python reference decoder for browser-free validation
+
+Decodes a ZTML output by reading the parameters embedded in its generated JS decoder,
+and running the Python counterparts of the decoding stages: bin2txt, PNG, BWT on bits, Huffman,
+MTF and BWT on text, dictionary and text_prep.
+Packing is undone, shared decoders and workers are inlined, and the literals are masked before matching,
+so that the parameters are located with patterns which tolerate the aliasing of webify.uglify().
+This covers the outputs of ztml() for all its options, but not arbitrary scripts.
+Shared decoders and sidecar PNGs are read from the folder of the output.
+This does not run the JS itself, and so does not catch JS or browser specific issues,
+but it runs without a browser, and is much faster for bulk validation.
+"""
+
+
+from base64 import b64decode
+from itertools import product
+import os
+from random import Random
+import sys
+from typing import AnyStr, List, Tuple, Union
+from urllib.parse import unquote
+
+import numpy as np
+import regex
+
+if not __package__:
+    import base125, base139, bwt_mtf, default_vars, deflate, dictionary, text_prep, webify
+else:
+    # noinspection PyPackages
+    from . import base125, base139, bwt_mtf, default_vars, deflate, dictionary, text_prep, webify
+
+
+browser_name = 'python'  # Pseudo browser for validation.validate_files() and ztml(validate=True)
+single_byte_charsets = ['cp1252', 'iso-8859-1', 'l1', 'latin1', 'windows-1252']
+
+
+template_regex = webify.literals_regex[1:-1]
+string_regex = r'\'[^\'\\\n]*(?:\\.[^\'\\\n]*)*\'|"[^"\\\n]*(?:\\.[^"\\\n]*)*"'
+lit = '\0(\\d+)\0'  # Placeholder of a masked literal
+prop = r'(?:\.\w+|\[\w+\])'  # Property access, which may be aliased by webify.uglify()
+cp1252_table = {i: bytes([i]).decode('cp1252') for i in range(128, 160) if i not in [0x81, 0x8d, 0x8f, 0x90, 0x9d]}
+
+
+escape_pattern = regex.compile(r'\\(?:u\{([\da-fA-F]+)\}|u([\da-fA-F]{4})|x([\da-fA-F]{2})|(.))', regex.DOTALL)
+single_escapes = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v', '0': '\0', '\n': ''}
+surrogate_pattern = regex.compile('[\ud800-\udfff]')
+pack_pattern = regex.compile(rf'(\w+)=({template_regex})\nfor\((\w+) of({template_regex})\)with\(\1\.split\(\3\)\)\1=join\(pop\(\)\)\neval\(\1\)\s*$')
+hoisted_pattern = regex.compile(rf'(\w+)=({template_regex}|{string_regex})\n')
+shared_pattern = regex.compile(rf'{default_vars.shared_decoder}=\(\.\.\.(\w+)\)=>{{([\s\S]*)}}\s*$')
+worker_pattern = regex.compile(rf'new \w+\(\w+{prop}\(new \w+\(\[({template_regex})\]\)\)\)')
+worker_start_pattern = regex.compile(r'\bonmessage=async \w+=>')
+crenc_pattern = regex.compile(rf'^\s*,c=>\(?\(i=c.*?%65533\)>>8\?129\+{lit}.*?\(c\):i\)(?:-(\d+)\))?')
+crenc_lookup_pattern = regex.compile(rf'^\s*;?\s*m=new \w+\(65536\){prop}\(\(_,i\)=>i(?:-(\d+))?\);?\[\.\.\.{lit}\]')
+base_pattern = regex.compile(rf'^\]{prop}\(c=>\(i=')
+base125_offset_pattern = regex.compile(r'v=n(?:-(\d+))?,')
+base139_offset_pattern = regex.compile(r'&255n\)(?:-(\d+))?\)')
+bit_len_pattern = regex.compile(r'for\(j=(\d+);j--;\)\w+\[j\]=s\[j\*4\]>>7&1')
+bit_len_bytes_pattern = regex.compile(rf'for\(k=8;k--;\)\w+\[j\*8\+k\]=s\[j(?:\*4)?\]>>7-k&1\s*;?\s*\w+{prop}=(\d+)')
+bwt_pattern = regex.compile(rf'\b{default_vars.bwt_func}\(\w+,(\d+)\)')
+huffman_pattern = regex.compile(rf'\[\.\.\.{lit}\]\s*;?\s*\w+=\[\.\.\.{lit}\]\s*;?\s*for\(j=\w+=')
+mtf_pattern = regex.compile(r'for\(k of \w+\)([^\n;]*)')
+mtf_ops = [('(k>1?k/2:k>n,0,', 52), ('(k>!!n,0,', 2), ('(k>1,0,', 1), ('(k/2,0,', 50)]
+mtf_fraction_pattern = regex.compile(r'\(k\*(\.\d+)\+\.5,0,')
+bwtsort_pattern = regex.compile(rf'\[\.\.\.{lit}\]{prop}\(\(c,i\)=>d\[c\]=\[\.\.\.{lit}\]\[i\]\)')
+dictionary_pattern = regex.compile(rf'slice\(k=\w+{prop}-(\d+)\).*?\({lit},{lit}\)', regex.DOTALL)
+dictionary_class_pattern = regex.compile(r'\[\\u([\da-f]{4})-\\u([\da-f]{4})\]')
+
+
+def unescape(literal: str) -> str:
+    # Value of a JS template or string literal, as escaped by webify.escape() and webify.safe_encode()
+    value = escape_pattern.sub(lambda m: single_escapes.get(m[4], m[4]) if m[4] is not None else chr(int(m[1] or m[2] or m[3], 16)), literal[1:-1])
+    if surrogate_pattern.search(value):
+        value = value.encode('utf-16', 'surrogatepass').decode('utf-16')
+    return value
+
+
+def decode_html(data: bytes, charset: str) -> str:
+    # As the browser would read it, with the HTML overrides of NUL and CR
+    if charset.lower() in single_byte_charsets:
+        text = data.decode('l1').translate(cp1252_table)
+    else:
+        text = data.decode('utf8', 'replace')
+    return text.replace('\0', '\ufffd').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def get_script(out: bytes, js: bool = False, encoding: str = '') -> Tuple[str, str, str]:
+    # Return the script, the src of a shared decoder if any, and the charset
+    if js:
+        if not encoding:
+            try:
+                out.decode('utf8')
+                encoding = 'utf8'
+            except UnicodeDecodeError:
+                encoding = 'cp1252'
+        return decode_html(out, encoding), '', encoding
+    head = out[:1000].decode('l1')
+    charset = regex.search(r'<meta charset=([\w-]+)>', head)
+    charset = charset[1] if charset else encoding or 'utf8'
+    src = regex.search(r'<script src=([^>\s]+)></script>', head)
+    start = out.index(b'<script>', src.end() if src else 0) + len(b'<script>')
+    end = out.rindex(b'</script>')
+    return decode_html(out[start:end], charset), src[1] if src else '', charset
+
+
+def read_sibling(url: str, base_dir: str) -> bytes:
+    path = unquote(regex.sub('^file:///', '', url))
+    with open(path if os.path.isabs(path) or regex.match('^[A-Za-z]:/', path) else os.path.join(base_dir, path), 'rb') as f:
+        return f.read()
+
+
+def unpack(script: str) -> str:
+    # Undo webify.pack(), and put back the literals it hoisted
+    m = pack_pattern.search(script)
+    if not m:
+        return script
+    code = unescape(m[2])
+    for token in unescape(m[4]):
+        parts = code.split(token)
+        code = parts.pop().join(parts)
+    hoisted = {h[1]: h[2] for h in hoisted_pattern.finditer(script[:m.start()])}
+    if hoisted:
+        code = ''.join(hoisted.get(text, text) if kind == 'name' else text for kind, text in webify.tokenize(code))
+    return code
+
+
+def inline_shared_decoder(call: str, decoder: str) -> str:
+    # Undo webify.split_decoder(), putting the literals of the call back into the decoder code
+    m = shared_pattern.search(decoder)
+    assert m, 'Error: shared decoder not recognized'
+    tokens = [text for kind, text in webify.tokenize(call[call.index('(') + 1 : call.rindex(')')]) if kind not in ['space', 'comment'] and text != ',']
+    return regex.sub(rf'\b{m[1]}\[(\d+)\]', lambda x: tokens[int(x[1])], m[2])
+
+
+def inline_workers(code: str) -> str:
+    # Every progressive segment has its own worker
+    return worker_pattern.sub(lambda m: m[0][:m.start(1) - m.start()] + unescape(m[1]) + m[0][m.end(1) - m.start():], code)
+
+
+def mask_literals(code: str) -> Tuple[str, List[str], List[Tuple[int, str]]]:
+    # Replace template and string literals with placeholders, so that patterns do not match inside them.
+    # Return the skeleton, the literals, and the positions in the skeleton of regular expressions and strings
+    literals = []
+    tokens = []
+    skeleton = []
+    pos = 0
+    for kind, text in webify.tokenize(code):
+        if kind in ['template', 'string']:
+            if kind == 'string':
+                tokens.append((pos, text))
+            literals.append(text)
+            text = f'\0{len(literals) - 1}\0'
+        elif kind == 'regex':
+            tokens.append((pos, text))
+        skeleton.append(text)
+        pos += len(text)
+    return ''.join(skeleton), literals, tokens
+
+
+def decode_payload(kind: str, literal: str, pre: str, post: str, literals: List[str], base_dir: str) -> bytes:
+    if kind == 'base64':
+        return b64decode(unescape(literal).split(',', 1)[1])
+    if kind == 'url':
+        return read_sibling(unescape(literal), base_dir)
+    value = unescape(literal)
+    if kind == 'crenc':
+        m = crenc_pattern.match(post)
+        overrides = unescape(literals[int(m[1])])
+        offset = int(m[2] or 0)
+        return bytes(((129 + overrides.find(c) if (i := ord(c) % 65533) >> 8 else i) - offset) & 255 for c in value)
+    if kind == 'crenc_lookup':
+        m = crenc_lookup_pattern.match(post)
+        offset = int(m[1] or 0)
+        table = [(i - offset) & 255 for i in range(65536)]
+        for i, c in enumerate(unescape(literals[int(m[2])])):
+            table[ord(c)] = (i + 128 - offset) & 255
+        return bytes(table[ord(c) % 65533] for c in value)
+    data = value.replace('\ufffd', '\0').encode()
+    if kind == 'base125':
+        return base125.decode(data, int(base125_offset_pattern.findall(pre)[-1] or 0))
+    return base139.decode(data, int(base139_offset_pattern.search(post)[1] or 0))
+
+
+def png_to_bits(image_data: bytes, bit_len: int) -> List[int]:
+    pixels = deflate.load_png(image_data)
+    if image_data[24] == 1:  # IHDR bit depth
+        return pixels[:bit_len]
+    return np.unpackbits(np.array(pixels, np.uint8))[:bit_len].tolist()
+
+
+def huffman_decode(bits: List[int], charset: str, canonical_table: str) -> str:
+    # Same loop as huffman.get_js_decoder()
+    table = [ord(c) for c in canonical_table]
+    out = []
+    j = 0
+    while j < len(bits):
+        k = c = 0
+        while True:
+            m = 2**k - table[k * 2] - c
+            k += 1
+            if m >= 0:
+                break
+            c += c + bits[j]
+            j += 1
+        out.append(charset[table[k * 2 - 1] + m])
+    return ''.join(out)
+
+
+def get_text_prep_candidates() -> List[Tuple[List[str], Tuple[str, bool, bool, bool]]]:
+    # The regular expressions and strings of the text_prep JS decoder for every combination of modes, longest first
+    candidates = []
+    for caps, the, quq, fused in product(text_prep.caps_modes, [True, False], [True, False], [True, False]):
+        tokens = [text for kind, text in webify.tokenize(text_prep.get_js_decoder(caps=caps, the=the, quq=quq, fused=fused)) if kind in ['regex', 'string']]
+        candidates.append((tokens, (caps, the, quq, fused)))
+    return sorted(candidates, key=lambda x: -len(x[0]))
+
+
+text_prep_candidates = get_text_prep_candidates()
+
+
+def get_text_prep_modes(tokens: List[str]) -> Tuple[str, bool, bool, bool]:
+    for candidate, modes in text_prep_candidates:
+        if any(tokens[i : i + len(candidate)] == candidate for i in range(len(tokens) - len(candidate) + 1)):
+            return modes
+    return 'raw', False, False, False
+
+
+def decode_segment(kind: str,
+                   literal: str,
+                   pre: str,
+                   post: str,
+                   stages: str,
+                   tokens: List[Tuple[int, str]],
+                   literals: List[str],
+                   base_dir: str
+                   ) -> AnyStr:
+    # The decoding stages are searched in the given part of the skeleton, with the tokens positioned relative to it
+    payload = decode_payload(kind, literal, pre, post, literals, base_dir)
+    bit_len = bit_len_pattern.search(stages) or bit_len_bytes_pattern.search(stages)
+    if not bit_len:  # Image
+        return payload
+    bits = png_to_bits(payload, int(bit_len[1]))
+    bwt_indices = bwt_pattern.finditer(stages)
+    bits = bwt_mtf.decode(bits, int(next(bwt_indices)[1]), bwtsort=False, mtf=None)
+    huffman = huffman_pattern.search(stages)
+    text = huffman_decode(bits, unescape(literals[int(huffman[1])]), unescape(literals[int(huffman[2])]))
+
+    mtf = None
+    op = mtf_pattern.search(stages)
+    if op:
+        fraction = mtf_fraction_pattern.search(op[1])
+        mtf = round(float(fraction[1]) * 100) if fraction else next((variant for s, variant in mtf_ops if s in op[1]), 0)
+    bwtsort = bool(bwtsort_pattern.search(stages))
+    text = bwt_mtf.decode(text, int(next(bwt_indices)[1]), bwtsort, mtf)
+
+    m = dictionary_pattern.search(stages)
+    if m:
+        char_class = dictionary_class_pattern.fullmatch(unescape(literals[int(m[2])]))
+        base = int(char_class[1], 16)
+        text = dictionary.decode(text, int(m[1]), base, int(char_class[2], 16) - base + 1)
+
+    modes = get_text_prep_modes([text for pos, text in tokens if pos >= huffman.end()])
+    return text_prep.decode(text, *modes)
+
+
+def classify_payload(skeleton: str, start: int, end: int, literal: str) -> str:
+    if literal.startswith("'data:;base64,"):
+        return 'base64'
+    if literal[0] in '\'"' and literal[-5:-1].lower() == '.png':
+        return 'url'
+    if literal[0] != '`':
+        return ''
+    after = skeleton[end:end + 200]
+    if crenc_pattern.match(after):
+        return 'crenc'
+    if skeleton[start - 2 : start] == 's=' and crenc_lookup_pattern.match(after):
+        return 'crenc_lookup'
+    if skeleton[start - 4 : start] == '[...' and base_pattern.match(after):
+        return 'base125' if '(e=i>>9' in after else 'base139'
+    return ''
+
+
+def decode(out: bytes,
+           base_dir: str = '',
+           js: bool = False,
+           encoding: str = ''
+           ) -> Union[str, bytes]:
+    script, src, charset = get_script(out, js, encoding)
+    if src:
+        script = inline_shared_decoder(script, decode_html(read_sibling(src, base_dir), charset))
+    code = inline_workers(unpack(script))
+    skeleton, literals, tokens = mask_literals(code)
+    payloads = []
+    for m in regex.finditer(lit, skeleton):
+        kind = classify_payload(skeleton, m.start(), m.end(), literals[int(m[1])])
+        if kind:
+            payloads.append((kind, int(m[1]), m.start(), m.end()))
+    assert payloads, 'Error: no payload found'
+    # The stages of a segment follow its payload, or are in its worker, which may come before or after the payload (for a URL or inline data)
+    worker_starts = [m.start() for m in worker_start_pattern.finditer(skeleton)]
+    assert len(worker_starts) in [0, len(payloads)], 'Error: workers do not match the payloads'
+    segments = []
+    for i, (kind, index, start, end) in enumerate(payloads):
+        pre_start = payloads[i - 1][3] if i else 0
+        post_end = payloads[i + 1][2] if i + 1 < len(payloads) else len(skeleton)
+        pre = skeleton[pre_start:start]
+        post = skeleton[end:post_end]
+        if len(payloads) == 1:
+            stages_start, stages = 0, skeleton
+        elif worker_starts:
+            stages_start = worker_starts[i]
+            stages = skeleton[stages_start : worker_starts[i + 1] if i + 1 < len(worker_starts) else len(skeleton)]
+        else:
+            stages_start, stages = end, post
+        stages_tokens = [(pos - stages_start, text) for pos, text in tokens if stages_start <= pos < stages_start + len(stages)]
+        segments.append(decode_segment(kind, literals[index], pre, post, stages, stages_tokens, literals, base_dir))
+    if len(segments) > 1:  # The first segment comes after the functions of the later segments
+        segments = segments[-1:] + segments[:-1]
+    if isinstance(segments[0], bytes):
+        return segments[0]
+    return ''.join(segments)
+
+
+def decode_file(filename: str, encoding: str = '') -> Union[str, bytes]:
+    with open(filename, 'rb') as f:
+        out = f.read()
+    return decode(out, os.path.dirname(filename), os.path.splitext(filename)[-1].lower() == '.js', encoding)
+
+
+def validate(file: Union[str, bytes],
+             data: AnyStr,
+             caps: str = text_prep.default_caps,
+             base_dir: str = '',
+             js: bool = False,
+             encoding: str = '',
+             verbose: bool = True
+             ) -> bool:
+    decoded = decode_file(file, encoding) if isinstance(file, str) else decode(file, base_dir, js, encoding)
+    if isinstance(data, str):
+        data = text_prep.get_expected(data, caps)
+    if decoded == data:
+        return True
+    if verbose:
+        i = next((i for i, (r, t) in enumerate(zip(decoded, data)) if r != t), min(len(decoded), len(data)))
+        print(f'\nFirst difference found at {i} / {len(decoded)}', file=sys.stderr)
+        print(f'Original: {data[max(i - 30, 0) : i]!r} -> {data[i : i + 50]!r}', file=sys.stderr)
+        print(f'Decoded: {decoded[max(i - 30, 0) : i]!r} -> {decoded[i : i + 50]!r}\n', file=sys.stderr)
+    return False
+
+
+def test() -> None:
+    if not __package__:
+        import ztml
+    else:
+        # noinspection PyPackages
+        from . import ztml
+    texts = ['Hello world!\n\nThe quick brown fox. I said: "Quit the queue".\n', 'שלום עולם 😀 \x00\r\n' * 20]
+    options = [{}, dict(bin2txt='base125'), dict(bin2txt='base139'), dict(bin2txt='base64'), dict(crenc_lookup=True),
+               dict(caps='raw', mtf=None, bwtsort=False), dict(caps='simple', mtf=52), dict(bitdepth=24, uglify=False, pack=False),
+               dict(js=True), dict(raw=True), dict(worker=True), dict(worker=True, timing=True), dict(fused_text_decoder=True, timing=True),
+               dict(dict_words=16)]
+    for text in texts:
+        data = text_prep.normalize(text)
+        for kwargs in options:
+            out = ztml.ztml(text, **kwargs)
+            assert validate(out, data, kwargs.get('caps', text_prep.default_caps), js=kwargs.get('js', False)), kwargs
+    text = texts[0] * 1000  # Three segments
+    data = text_prep.normalize(text)
+    for kwargs in [dict(progressive=True), dict(progressive=True, worker=True), dict(progressive=True, worker=True, bin2txt='base64')]:
+        assert validate(ztml.ztml(text, **kwargs), data), kwargs
+    rng = Random(0)
+    words = ['extraordinary', 'comprehension', 'international', 'responsibility', 'neighbourhood', 'sophisticated',
+             'understanding', 'circumstances', 'consciousness', 'acknowledgment', 'philosophical', 'unfortunately']
+    text = ' '.join(rng.choice(words) for _ in range(600))  # Long words in random order, where the dictionary makes the output smaller
+    out = ztml.ztml(text, dict_words=16)
+    assert len(out) < len(ztml.ztml(text)) and validate(out, text_prep.normalize(text))
+
+
+if __name__ == '__main__':
+    test()
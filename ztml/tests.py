@@ -1,13 +1,26 @@
+import argparse
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from functools import wraps
+from hashlib import sha256
+from io import BytesIO, TextIOWrapper
+from itertools import groupby, product
 import os
+import pickle
+import shlex
+import subprocess
+import sys
 from time import time
+from typing import Callable, Tuple
+from unittest.mock import patch
 
 start_time = time()
 
 if not __package__:
-    import text_prep, bwt_mtf, deflate, validation, webify, ztml
+    import base125, base139, bwt_mtf, crenc, deflate, huffman, text_prep, validation, webify, ztml
 else:
     # noinspection PyPackages
-    from . import text_prep, bwt_mtf, deflate, validation, webify, ztml
+    from . import base125, base139, bwt_mtf, crenc, deflate, huffman, text_prep, validation, webify, ztml
 
 
 min_char_code1 = 0
@@ -23,76 +36,142 @@ bitdepths = deflate.allowed_bitdepths
 ect_modes = [False, True]
 temp_folder = 'tmp'
 cleanup = True
+max_cached = 16  # Results kept per memoized stage
 
 
+def memoize(func: Callable) -> Callable:
+    # Cache a pipeline stage by a digest of its arguments, so that test cases sharing a prefix of stages compute it once.
+    # Results are kept pickled, so that callers cannot mutate the cached copy
+    cache = OrderedDict()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = sha256(pickle.dumps((args, kwargs))).digest()
+        if key in cache:
+            cache.move_to_end(key)
+        else:
+            cache[key] = pickle.dumps(func(*args, **kwargs))
+            if len(cache) > max_cached:
+                cache.popitem(last=False)
+        return pickle.loads(cache[key])
+    return wrapper
+
+
+def run_cli(args: str) -> Tuple[int, bytes]:
+    # Run the CLI in this process, so that it reuses the memoized stages and the pooled browser sessions.
+    # Return the exit code and the stdout bytes
+    stdout = TextIOWrapper(BytesIO())
+    with patch.object(sys, 'argv', ['ztml.py'] + shlex.split(args)), redirect_stdout(stdout):
+        try:
+            ztml.main()
+            code = 0
+        except SystemExit as e:
+            code = e.code or 0
+        stdout.flush()
+    return code, stdout.buffer.getvalue()
+
+
+# Stages up to the PNG are shared by all bin2txt encodings and render modes, and bin2txt by all render modes
+for module, name in [(text_prep, 'encode_and_get_js_decoder'), (bwt_mtf, 'encode_and_get_js_decoder'),
+                     (huffman, 'encode_and_get_js_decoder'), (deflate, 'to_png'), (base125, 'get_js_decoder'),
+                     (base139, 'get_js_decoder'), (crenc, 'get_js_decoder')]:
+    setattr(module, name, memoize(getattr(module, name)))
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--shard_count', type=int, default=1)
+parser.add_argument('--shard_index', type=int, help='Run a single shard. By default, all shards are run in parallel processes')
+args = parser.parse_args()
+if args.shard_count > 1 and args.shard_index is None:
+    processes = [subprocess.Popen([sys.executable, __file__, '--shard_count', str(args.shard_count), '--shard_index', str(shard_index)])
+                 for shard_index in range(args.shard_count)]
+    error = any([process.wait() for process in processes])
+    print(f'{args.shard_count} shards took {(time()-start_time) / 60 :.1f} min.')
+    sys.exit(int(error))
+shard_index = args.shard_index or 0
+assert 0 <= shard_index < args.shard_count
+
+# Shard by the stages before bin2txt, so that the memoized stages are reused within a shard
+groups = list(product(browsers, input_encodings, caps_modes, [True, False], mtf_variants, bitdepths, ect_modes))[shard_index::args.shard_count]
+cases = list(product(bin2txt_encodings, range(3)))
 all_chars = ''.join(chr(i) for i in range(min_char_code1, min(max_char_code1 or bwt_mtf.max_unicode, bwt_mtf.max_unicode) + 1))
 if min_char_code2 and max_char_code2:
     all_chars += ''.join(chr(i) for i in range(min_char_code2, min(max_char_code2 or bwt_mtf.max_unicode, bwt_mtf.max_unicode) + 1) if chr(i) not in all_chars)
 os.makedirs(temp_folder, exist_ok=True)
 i = 0
-for browser in browsers:
+for browser, browser_groups in groupby(groups, key=lambda group: group[0]):
+    rendered = set()  # Digests of validated outputs, as identical outputs need to be rendered only once by the API and once by the CLI
     with validation.get_browser(browser) as b:
-        for encoding in input_encodings:
+        for _, encoding, caps, bwtsort, mtf, bitdepth, ect in browser_groups:
             encoding = encoding.lower()
-            for bin2txt in bin2txt_encodings:
-                for caps in caps_modes:
-                    for bwtsort in [True, False]:
-                        for mtf in mtf_variants:
-                            for bitdepth in bitdepths:
-                                for ect in ect_modes:
-                                    for render_mode in range(3):
-                                        element_id = ''
-                                        raw = False
-                                        if render_mode == 1:
-                                            element_id = 'myid'
-                                        elif render_mode == 2:
-                                            raw = True
-                                        test_start_time = time()
-                                        i += 1
-                                        print(f'{i}/{len(browsers) * len(input_encodings) * len(bin2txt_encodings) * len(caps_modes) * 2 * len(mtf_variants) * len(bitdepths) * len(ect_modes) * 3} browser={browser} input_enc={encoding} bin2txt={bin2txt} caps={caps} bwtsort={bwtsort} mtf={mtf} bitdepth={bitdepth} ect={ect} id={bool(element_id)} raw={raw}')
-                                        suffix = f"{browser}_{encoding}_{bin2txt}_{caps}{'_bwtsort' * bwtsort}_{mtf}_{bitdepth}{'_ect' * ect}"
-                                        if element_id:
-                                            suffix += '_id'
-                                        if raw:
-                                            suffix += '_raw'
-                                        input_filename = os.path.join(temp_folder, f'ztml_test_file_{suffix}.txt')
-                                        output_filename = os.path.join(temp_folder, f'ztml_test_file_{suffix}.html')
-                                        output_stream = os.path.join(temp_folder, f'ztml_test_stream_{suffix}.html')
-                                        text = all_chars
-                                        if mtf is not None:
-                                            text = ''.join(c for c in text if ord(c) <= bwt_mtf.max_ord_for_mtf)
-                                        if encoding.replace('-', '') == 'utf8':
-                                            text = ''.join(c for c in text if ord(c) < bwt_mtf.surrogate_lo or ord(c) > bwt_mtf.surrogate_hi)
-                                            out1, result1 = ztml.ztml(text, unix_newline=False, remove_bom=False, caps=caps, bwtsort=bwtsort, mtf=mtf, bitdepth=bitdepth, ect=ect, bin2txt=bin2txt, element_id=element_id, raw=raw, validate=True, browser=b, verbose=True)
-                                            out2, result2 = ztml.ztml(text, output_filename, unix_newline=False, remove_bom=False, caps=caps, bwtsort=bwtsort, mtf=mtf, bitdepth=bitdepth, ect=ect, bin2txt=bin2txt, element_id=element_id, raw=raw, validate=True, browser=b, verbose=True)
-                                            with open(output_filename, 'rb') as f:
-                                                out = f.read()
-                                            assert not result1 and not result2 and out1 == out2 == out, (result1, result2, out1 == out2, out1 == out, out2 == out, len(out1), len(out2), validation.full_path(output_filename), len(out))
-                                        with open(input_filename, 'wb') as f:
-                                            f.write(webify.safe_encode(text, encoding))
-                                        bwtsort_arg = '--skip_bwtsort' * (not bwtsort)
-                                        ect_arg = '--ect' * ect
-                                        element_id_or_raw_arg = ''
-                                        if element_id:
-                                            element_id_or_raw_arg = f'--element_id "{element_id}"'
-                                        if raw:
-                                            element_id_or_raw_arg = '--raw'
-                                        result1 = os.system(f'python ztml.py "{input_filename}" "{output_filename}" --skip_unix_newline --skip_remove_bom --caps {caps} {bwtsort_arg} --mtf {mtf} --bitdepth {bitdepth} {ect_arg} --bin2txt {bin2txt} {element_id_or_raw_arg} --validate --browser {browser} --verbose')
-                                        result2 = os.system(f'python ztml.py "{input_filename}" --skip_unix_newline --skip_remove_bom --caps {caps} {bwtsort_arg} --mtf {mtf} --bitdepth {bitdepth} {ect_arg} --bin2txt {bin2txt} {element_id_or_raw_arg} --validate --browser {browser} --verbose > {output_stream}')
-                                        with open(output_filename, 'rb') as f1:
-                                            out1 = f1.read()
-                                        with open(output_stream, 'rb') as f2:
-                                            out2 = f2.read()
-                                        if out2.endswith(b'\x1b[0m'):  # E.g. due to PyCharm terminal
-                                            out2 = out2[:-4]
-                                        assert not result1 and not result2 and out1 == out2, (result1, result2, out1 == out2, validation.full_path(output_filename), len(out1), validation.full_path(output_stream), len(out2))
-                                        if cleanup:
-                                            for filename in [input_filename, output_filename, output_stream]:
-                                                try:
-                                                    os.remove(filename)
-                                                except PermissionError:
-                                                    pass
-                                        print(f'Test took {time() - test_start_time :.0f} sec.\n')
+            prefix = f'{browser}_{encoding}_{caps}{"_bwtsort" * bwtsort}_{mtf}_{bitdepth}{"_ect" * ect}'
+            input_filename = os.path.join(temp_folder, f'ztml_test_file_{prefix}.txt')
+            text = all_chars
+            if mtf is not None:
+                text = ''.join(c for c in text if ord(c) <= bwt_mtf.max_ord_for_mtf)
+            if encoding.replace('-', '') == 'utf8':
+                text = ''.join(c for c in text if ord(c) < bwt_mtf.surrogate_lo or ord(c) > bwt_mtf.surrogate_hi)
+            with open(input_filename, 'wb') as f:
+                f.write(webify.safe_encode(text, encoding))
+            data = ztml.read_input(input_filename)  # As the CLI reads it
+            for bin2txt, render_mode in cases:
+                element_id = ''
+                raw = False
+                if render_mode == 1:
+                    element_id = 'myid'
+                elif render_mode == 2:
+                    raw = True
+                test_start_time = time()
+                i += 1
+                print(f'{i}/{len(groups) * len(cases)} shard={shard_index}/{args.shard_count} browser={browser} input_enc={encoding} bin2txt={bin2txt} caps={caps} bwtsort={bwtsort} mtf={mtf} bitdepth={bitdepth} ect={ect} id={bool(element_id)} raw={raw}')
+                suffix = f'{prefix}_{bin2txt}'
+                if element_id:
+                    suffix += '_id'
+                if raw:
+                    suffix += '_raw'
+                output_filename = os.path.join(temp_folder, f'ztml_test_file_{suffix}.html')
+                output_stream = os.path.join(temp_folder, f'ztml_test_stream_{suffix}.html')
+                kwargs = dict(unix_newline=False, remove_bom=False, caps=caps, bwtsort=bwtsort, mtf=mtf, bitdepth=bitdepth, ect=ect, bin2txt=bin2txt, element_id=element_id, raw=raw, browser=b, verbose=True)
+                out1 = ztml.ztml(data, **kwargs)
+                digest = sha256(out1).digest()
+                validate = digest not in rendered
+                out2 = ztml.ztml(data, output_filename, validate=validate, **kwargs)
+                result = False
+                if validate:
+                    out2, result = out2
+                    rendered.add(digest)
+                with open(output_filename, 'rb') as f:
+                    out = f.read()
+                assert not result and out1 == out2 == out, (result, out1 == out2, out1 == out, out2 == out, len(out1), len(out2), validation.full_path(output_filename), len(out))
+
+                # The CLI outputs are compared with the output of the API, and the file output is also validated for new digests
+                validate_arg = f'--validate --browser {browser}' * validate
+                bwtsort_arg = '--skip_bwtsort' * (not bwtsort)
+                ect_arg = '--ect' * ect
+                element_id_or_raw_arg = ''
+                if element_id:
+                    element_id_or_raw_arg = f'--element_id "{element_id}"'
+                if raw:
+                    element_id_or_raw_arg = '--raw'
+                result1, _ = run_cli(f'"{input_filename}" "{output_filename}" --skip_unix_newline --skip_remove_bom --caps {caps} {bwtsort_arg} --mtf {mtf} --bitdepth {bitdepth} {ect_arg} --bin2txt {bin2txt} {element_id_or_raw_arg} {validate_arg} --verbose')
+                result2, out2 = run_cli(f'"{input_filename}" --skip_unix_newline --skip_remove_bom --caps {caps} {bwtsort_arg} --mtf {mtf} --bitdepth {bitdepth} {ect_arg} --bin2txt {bin2txt} {element_id_or_raw_arg} --verbose')
+                with open(output_stream, 'wb') as f2:  # Kept for inspection on failure
+                    f2.write(out2)
+                with open(output_filename, 'rb') as f1:
+                    out1 = f1.read()
+                assert not result1 and not result2 and out1 == out2 == out, (result1, result2, out1 == out2, out1 == out, validation.full_path(output_filename), len(out1), validation.full_path(output_stream), len(out2))
+                if cleanup:
+                    for filename in [output_filename, output_stream]:
+                        try:
+                            os.remove(filename)
+                        except PermissionError:
+                            pass
+                print(f'Test took {time() - test_start_time :.0f} sec.\n')
+            if cleanup:
+                try:
+                    os.remove(input_filename)
+                except PermissionError:
+                    pass
 if cleanup:
     try:
         os.rmdir(temp_folder)
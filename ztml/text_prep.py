@@ -1,5 +1,8 @@
+from collections import Counter
+from contextlib import nullcontext
+from random import Random
 import sys
-from typing import Optional, Tuple
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 import regex
 
@@ -16,8 +19,43 @@ double_quote = '[\u201c-\u201f\u05f4\uff02]'
 apos = "['’]"  # \\uff07
 eos = '[!.?]'  # r'\uff01\uff0e\uff1f\ufe52\ufe56\ufe57'
 nonword = r'\p{L}\p{M}\p{N}'
-caps_modes = ['auto', 'lower', 'raw', 'simple', 'upper']
+caps_modes = ['auto', 'lower', 'modifiers', 'raw', 'simple', 'upper']
 default_caps = 'auto'
+first_segment_len = 5000
+segment_growth = 4
+
+
+whitespace_run_pattern = regex.compile(r'\s{2,}|[^\S ]')  # Skip single spaces
+newline_pattern = regex.compile(f'[{newline}]')
+crlf_pattern = regex.compile('\r\n?')
+dash_pattern = regex.compile(r'\p{Pd}')
+single_quote_pattern = regex.compile(single_quote)
+double_quote_pattern = regex.compile(double_quote)
+default_chunk_size = 2 ** 22
+
+
+def reduce_whitespace_run(m: regex.Match) -> str:
+    # A single pass over whitespace runs, instead of separate passes for paragraphs, lines and spaces
+    newlines = len(newline_pattern.findall(m[0]))
+    return '\n\n' if newlines > 1 else '\n' if newlines else ' '
+
+
+def normalize_whitespace_and_punct(text: str,
+                                   reduce_whitespace: bool = False,
+                                   unix_newline: bool = True,
+                                   fix_punct: bool = False
+                                   ) -> str:
+    # Does not strip the text, so that it can be applied to chunks that do not split whitespace runs
+    if reduce_whitespace:
+        text = whitespace_run_pattern.sub(reduce_whitespace_run, text.replace('\u2029', '\n\n'))
+    elif unix_newline:
+        text = crlf_pattern.sub('\n', text)
+    if fix_punct:
+        text = dash_pattern.sub('-', text)
+        text = single_quote_pattern.sub("'", text)
+        text = double_quote_pattern.sub('"', text)
+        text = text.replace('\u2026', '...')
+    return text
 
 
 def normalize(text: str,
@@ -26,38 +64,209 @@ def normalize(text: str,
               fix_punct: bool = False,
               strip_bom: bool = True
               ) -> str:
+    text = normalize_whitespace_and_punct(text, reduce_whitespace, unix_newline, fix_punct)
     if reduce_whitespace:
-        text = regex.sub(rf'\s*[{newline}]\s*[{newline}]\s*', '\n\n', text.replace('\u2029', '\n\n'))
-        text = regex.sub(rf'[^\S{newline}]*[{newline}][^\S{newline}]*', '\n', text)
-        text = regex.sub(rf'[^\S{newline}]+', ' ', text)
         text = text.strip()
-    elif unix_newline:
-        text = regex.sub('\r\n?', '\n', text)
-    if fix_punct:
-        text = regex.sub('\\p{Pd}', '-', text)
-        text = regex.sub(single_quote, "'", text)
-        text = regex.sub(double_quote, '"', text)
-        text = regex.sub('\u2026', '...', text)
-    if strip_bom:
-        text = regex.sub('^\ufeff', '', text)
+    if strip_bom and text.startswith('\ufeff'):
+        text = text[1:]
     return text
 
 
-caps_regex = rf'(((?=(\r\n|[{newline}]))\3){{2,}}|\u2029|^|{eos})\P{{L}}*.|(^|[^{nonword}])i(?![{nonword}])'  # Avoid lookbehind to support Safari
+def normalize_chunks(chunks: Iterable[str],
+                     reduce_whitespace: bool = False,
+                     unix_newline: bool = True,
+                     fix_punct: bool = False,
+                     strip_bom: bool = True
+                     ) -> Iterator[str]:
+    # Streaming version of normalize(), e.g. for huge files, giving the same result when joined.
+    # The trailing whitespace of every chunk is carried over to the next one, so that whitespace and newline runs are never split
+    carry = ''
+    started = False
+    for chunk in chunks:
+        chunk = carry + chunk
+        head_len = len(chunk.rstrip())
+        carry = chunk[head_len:]
+        if not head_len:
+            continue
+        head = normalize_whitespace_and_punct(chunk[:head_len], reduce_whitespace, unix_newline, fix_punct)
+        if not started:
+            if reduce_whitespace:
+                head = head.lstrip()
+            if strip_bom and head.startswith('\ufeff'):
+                head = head[1:]
+            started = True
+        yield head
+    if not reduce_whitespace and carry:  # Otherwise, trailing whitespace is stripped
+        yield normalize_whitespace_and_punct(carry, reduce_whitespace, unix_newline, fix_punct)
+
+
+def normalize_file(input_filename: str,
+                   output_filename: str = '',
+                   reduce_whitespace: bool = False,
+                   unix_newline: bool = True,
+                   fix_punct: bool = False,
+                   strip_bom: bool = True,
+                   encoding: str = 'utf8',
+                   chunk_size: int = default_chunk_size
+                   ) -> None:
+    # Write to stdout by default
+    with open(input_filename, encoding=encoding, newline='') as f:
+        chunks = iter(lambda: f.read(chunk_size), '')
+        with open(output_filename, 'w', encoding='utf8', newline='') if output_filename else nullcontext(sys.stdout) as out:
+            for chunk in normalize_chunks(chunks, reduce_whitespace, unix_newline, fix_punct, strip_bom):
+                out.write(chunk)
+
+
+def split_segments(text: str,
+                   first_len: int = first_segment_len,
+                   growth: int = segment_growth
+                   ) -> List[str]:
+    # Cut after line breaks into geometrically growing segments, merging a short remainder into the last segment
+    segments = []
+    length = first_len
+    while len(text) > length * 1.5:
+        cut = text.rfind('\n', length // 2, length) + 1 or length
+        segments.append(text[:cut])
+        text = text[cut:]
+        length *= growth
+    return segments + [text]
+
+
+the_regex = '(^(?!$)| )( |$)'
+caps_modifiers = '\x01\x02\x03'  # Flip the case of the next letter, uppercase the next word, and uppercase a block up to the closing modifier
+escaped_caps_modifiers = r'\x01-\x03'
+min_block_words = 3
+max_modifiers_ratio = 0.04  # Of the text length, above which caps='raw' is preferred
+min_modifiers_len = 2**16  # Shorter texts do not amortize the modifiers decoder, so auto caps falls back to raw. Longer ones are also compared against raw by ztml()
+
+
+def get_caps_regex(modifiers: str = '', atomic: bool = False) -> str:
+    # The JS version emulates an atomic group with a lookahead. Avoid lookbehind to support Safari.
+    # With modifiers, the standalone i rule skips over them, so that inserting modifiers does not change the capitalization
+    newline_run = rf'(?>\r\n|[{newline}])' if atomic else rf'((?=(\r\n|[{newline}]))\3)'
+    i_regex = f'(^|[^{nonword}{modifiers}])[{modifiers}]*i(?![{modifiers}]*[{nonword}])' if modifiers else f'(^|[^{nonword}])i(?![{nonword}])'
+    return rf'({newline_run}{{2,}}|\u2029|^|{eos})\P{{L}}*.|{i_regex}'
+
+
+caps_regex = get_caps_regex()
+caps_modifiers_regex = get_caps_regex(escaped_caps_modifiers)
+modifiers_regex = r'\x03([^\x03]*)\x03|\x02(\p{L}*)|\x01(.)'
+caps_pattern = regex.compile(get_caps_regex(atomic=True))
+caps_modifiers_pattern = regex.compile(get_caps_regex(escaped_caps_modifiers, atomic=True))
+modifiers_pattern = regex.compile(modifiers_regex)
+cased_word_pattern = regex.compile(r'\p{L}*[\p{Lu}\p{Lt}]\p{L}*')
+letter_pattern = regex.compile(r'\p{L}')
 
 
 def decode_caps_simple(text: str) -> str:
-    return regex.sub(caps_regex, lambda m: m[0].upper(), text)
+    return caps_pattern.sub(lambda m: m[0].upper(), text)
+
+
+def is_auto_caps(text: str, lower: Optional[str] = None) -> bool:
+    # Same as text == decode_caps_simple(text.lower()), but stops at the first mismatch without building the decoded text
+    if lower is None:
+        lower = text.lower()
+    if len(lower) != len(text):
+        return text == decode_caps_simple(lower)
+    i = 0
+    for m in caps_pattern.finditer(lower):
+        start, end = m.span()
+        if text[i:start] != lower[i:start] or text[start:end] != m[0].upper():
+            return False
+        i = end
+    return text[i:] == lower[i:]
+
+
+def expand_caps_modifier(m: regex.Match) -> str:
+    if m[3]:
+        flipped = m[3].upper()
+        return m[3].lower() if flipped == m[3] else flipped
+    return (m[1] if m[1] is not None else m[2]).upper()
+
+
+def decode_caps_modifiers(text: str) -> str:
+    # Two passes, as in the JS decoder: the automatic capitalization matches span the modifiers (e.g. '. \x01a' and '\x01i'),
+    # and the letter modifier flips the case that the first pass decided. A single alternation would consume the modifier
+    # (or a block opening) inside the capitalization match, or lose the capitalization if the modifiers were excluded from it
+    text = caps_modifiers_pattern.sub(lambda m: m[0].upper(), text)
+    return modifiers_pattern.sub(expand_caps_modifier, text)
+
+
+def encode_caps_modifiers(text: str, lower: Optional[str] = None) -> Optional[str]:
+    # Lowercase the text, and insert modifiers only where its capitalization differs from decode_caps_simple(),
+    # in the spirit of the capital conversion of Grabowski and Batista&Alexandre.
+    # Only words with a capital in the text or in the automatic capitalization are visited, so that this runs in linear time.
+    # Return None if the text already contains modifiers, or cannot be represented
+    if lower is None:
+        lower = text.lower()
+    if len(lower) != len(text) or regex.search(f'[{escaped_caps_modifiers}]', text):
+        return None
+    predicted = decode_caps_simple(lower)
+    if len(predicted) != len(text):
+        return None
+    letter_modifier, word_modifier, block_modifier = caps_modifiers
+    spans = sorted({m.span() for m in cased_word_pattern.finditer(text)} | {m.span() for m in cased_word_pattern.finditer(predicted)})
+    inserts = []
+    run = []
+
+    def flush_run() -> None:
+        if len(run) >= min_block_words:
+            inserts.extend([(run[0][0], block_modifier), (run[-1][1], block_modifier)])
+            return
+        for start, end in run:
+            word = text[start:end]
+            if word == predicted[start:end]:
+                continue
+            if end - start > 1 and word == lower[start:end].upper():
+                inserts.append((start, word_modifier))
+                continue
+            inserts.extend((j, letter_modifier) for j in range(start, end) if text[j] != predicted[j])
+
+    for start, end in spans:
+        is_upper = text[start:end] == lower[start:end].upper() != lower[start:end]
+        if run and (not is_upper or not run[-1][1] < start or letter_pattern.search(text, run[-1][1], start)
+                    or text[run[-1][1]:start].upper() != text[run[-1][1]:start] or text[run[-1][1]:start] != predicted[run[-1][1]:start]):
+            flush_run()
+            run = []
+        run.append((start, end))
+        if not is_upper:
+            flush_run()
+            run = []
+    flush_run()
+    pieces = []
+    i = 0
+    for j, modifier in inserts:
+        pieces += [lower[i:j], modifier]
+        i = j
+    encoded = ''.join(pieces) + lower[i:]
+    return encoded if decode_caps_modifiers(encoded) == text else None
+
+
+def get_caps_modifiers_js_decoder() -> str:
+    return f".replace(/{caps_modifiers_regex}/gu,m=>m.toUpperCase()).replace(/{modifiers_regex}/gu,(m,b,w,f)=>f?(m=f.toUpperCase())==f?f.toLowerCase():m:(b||w).toUpperCase())"
 
 
 def encode_caps(text: str, caps: str = default_caps) -> str:
     assert caps in caps_modes, f"Error: caps='{caps}' not in {caps_modes}"
+    if caps == 'modifiers':
+        encoded = encode_caps_modifiers(text)
+        assert encoded is not None, "Error: text cannot be encoded with caps='modifiers'"
+        return encoded
     return text if caps == 'raw' else text.upper() if caps == 'upper' else text.lower()
 
 
+def get_the_encoder_regex(the_str: str) -> str:
+    return f'(^(?!{the_str}$)| ){the_str}( |$)'
+
+
 def remove_the(text: str) -> str:
     the_str = 'THE' if text == text.upper() else 'the'
-    return regex.sub(f'(^(?!{the_str}$)| ){the_str}( |$)', r'\1\2', text, flags=regex.MULTILINE)
+    return regex.sub(get_the_encoder_regex(the_str), r'\1\2', text, flags=regex.MULTILINE)
+
+
+def decode_the(text: str, caps: str) -> str:
+    the_str = 'THE' if caps == 'upper' else 'the'
+    return regex.sub(the_regex, rf'\1{the_str}\2', text, flags=regex.MULTILINE)
 
 
 def get_qu_regex(next_letter_case: str, u_caps: Optional[bool] = None) -> str:
@@ -65,9 +274,15 @@ def get_qu_regex(next_letter_case: str, u_caps: Optional[bool] = None) -> str:
     return f'(?={apos}?[^{u}\\P{{L{next_letter_case}}}])'
 
 
+quq_encoder_regex = f"([Qq])u{get_qu_regex('l')}|(Q)U{get_qu_regex('')}"
+quq_encoder_pattern = regex.compile(quq_encoder_regex)
+the_space_pattern = regex.compile('^ |  | $', regex.MULTILINE)
+q_pattern = regex.compile('[Qq]')
+quq_window_len = 4  # q, u, apostrophe and the next letter
+
+
 def encode_quq(text: str) -> str:
-    text = regex.sub(f"([Qq])u{get_qu_regex('l')}", '\\1', text)
-    return regex.sub(f"QU{get_qu_regex('')}", 'Q', text)
+    return quq_encoder_pattern.sub(r'\1\2', text)
 
 
 def decode_quq(text: str, caps: str) -> str:
@@ -91,12 +306,90 @@ def get_quq_js_decoder(caps: str) -> str:
     return js_decoder
 
 
+def get_quq_variants(caps: str) -> List[Tuple[str, str, str]]:
+    if caps == 'raw':
+        return [('[Qq]', get_qu_regex('l'), 'u'), ('Q', get_qu_regex('u'), 'U')]
+    if caps == 'upper':
+        return [('Q', get_qu_regex('', u_caps=True), 'U')]
+    return [('q', get_qu_regex(''), 'u')]
+
+
+def get_fused_regex(caps: str, the: bool, quq: bool) -> Tuple[str, List[str]]:
+    # Combine the quq, the and caps passes into a single regex, returning the names of its groups.
+    # A caps match spans a sentence boundary and the non-letters up to the first letter or restored the.
+    # An i following a restored the is matched together with it, as its preceding space is consumed.
+    # Assumes a '\n\n' sentinel is prepended to the text, to be a sentence boundary as well as a line start
+    variants = get_quq_variants(caps) if quq else []
+    if caps not in ['auto', 'simple']:
+        names = ['q', 'Q'][:len(variants)] + ['g', 'h'] * the
+        return '|'.join([f'({q}){look}' for q, look, _ in variants] + [the_regex] * the), names
+    the_i_regex = f'{the_regex}(i(?![{nonword}]))?'
+    boundary = rf'((?!\r\n(?![{newline}]))[{newline}]{{2}}|\u2029|{eos})'
+    run = r'((?:[^\p{L} ]|(?!^) (?! |$))*)' if the else r'(\P{L}*)'
+    first = [f"(q){get_qu_regex('')}"] * quq + [r'(\p{L}|(?![\s\S]))'] + [the_i_regex] * the
+    rest = [the_i_regex] * the + [f"q{get_qu_regex('')}"] * quq + [f'[^{nonword}]i(?![{nonword}])']
+    names = ['b', 'r'] + ['q'] * quq + ['l'] + ['g', 'h', 'i', 'G', 'H', 'I'] * the
+    return '|'.join([f"{boundary}{run}(?:{'|'.join(first)})"] + rest), names
+
+
+def get_fused_js_decoder(caps: str, the: bool, quq: bool, text_var: str = default_vars.text) -> str:
+    fused_regex, names = get_fused_regex(caps, the, quq)
+    if caps not in ['auto', 'simple']:
+        the_str = 'THE' if caps == 'upper' else 'the'
+        cases = [f"{name}+'{u}'" for name, (_, _, u) in zip(names, get_quq_variants(caps) * quq)] + [f"g+'{the_str}'+h"] * the
+        function = ''.join(f'{name}?{case}:' for name, case in zip(names, cases[:-1])) + cases[-1]
+        return f"{text_var}={text_var}.replace(/{fused_regex}/gmu,({','.join(['m'] + names)})=>{function})\n"
+    first = '||'.join(['q'] * quq + ['l'] + ["(h!=null?g+'t':'')"] * the)
+    rest = ["q?'u':"] * quq + ["h!=null?'he'+h+(i?'I':''):"] * the
+    function = f"b?(b+r+({first})).toUpperCase()+({''.join(rest)}''):"
+    function += "G!=null?G+'the'+H+(I?'I':''):" * the
+    function += "m[1]?m.toUpperCase():m+'u'" if quq else 'm.toUpperCase()'
+    return f"{text_var}=('\\n\\n'+{text_var}).replace(/{fused_regex}/gmu,({','.join(['m'] + names)})=>{function}).slice(2)\n"
+
+
+def fused_decode(text: str, caps: str, the: bool, quq: bool) -> str:
+    # Python counterpart of get_fused_js_decoder(), for validation against the chained decoders
+    fused_regex, names = get_fused_regex(caps, the, quq)
+    variants = get_quq_variants(caps)
+    the_str = 'THE' if caps == 'upper' else 'the'
+
+    def replace(m: regex.Match) -> str:
+        g = dict(zip(names, m.groups()))
+        if caps not in ['auto', 'simple']:
+            for name, (_, _, u) in zip(names, variants * quq):
+                if g[name]:
+                    return g[name] + u
+            return g['g'] + the_str + g['h']
+        if g['b']:
+            if g.get('q'):
+                return (g['b'] + g['r'] + 'q').upper() + 'u'
+            if g['l'] is not None:
+                return (g['b'] + g['r'] + g['l']).upper()
+            return (g['b'] + g['r'] + g['g'] + 't').upper() + 'he' + g['h'] + (g['i'] or '').upper()
+        if g.get('G') is not None:
+            return g['G'] + 'the' + g['H'] + (g['I'] or '').upper()
+        return m[0].upper() if len(m[0]) > 1 else m[0] + 'u'
+
+    if caps not in ['auto', 'simple']:
+        return regex.sub(fused_regex, replace, text, flags=regex.MULTILINE)
+    return regex.sub(fused_regex, replace, '\n\n' + text, flags=regex.MULTILINE)[2:]
+
+
+def get_quq_stats(text: str, caps: str) -> Tuple[int, int]:
+    # Return the number of u's removed by encode_quq(), and the number of q's not restored by decode_quq().
+    # Both only depend on a short window after every q, so the distinct windows are roundtripped instead of the whole text.
+    # A window may contain the next q, so only the u of its first q is counted
+    windows = Counter(text[m.start():m.start() + quq_window_len] for m in q_pattern.finditer(text))
+    removed = bad = 0
+    for window, cnt in windows.items():
+        enc = encode_quq(window)
+        removed += bool(quq_encoder_pattern.match(window)) * cnt
+        bad += (q_pattern.split(decode_quq(enc, caps))[1] != q_pattern.split(window)[1]) * cnt
+    return removed, bad
+
+
 def count_bad_quq(text: str, caps: str, verbose: bool = False) -> int:
-    text = encode_caps(text, caps)
-    recon = decode_quq(encode_quq(text), caps)
-    text = regex.split('[Qq]', text)
-    recon = regex.split('[Qq]', recon)
-    cnt = sum(a != b for a, b in zip(recon, text)) + abs(len(recon) - len(text))
+    cnt = get_quq_stats(encode_caps(text, caps), caps)[1]
     if verbose and cnt:
         print(f'Warning: found {cnt} cases of q followed by a non u, or terminal qu', file=sys.stderr)
     return cnt
@@ -111,42 +404,55 @@ def encode_with_fallbacks(text: str,
                           quq_fallback: bool = True,
                           verbose: bool = False
                           ) -> Tuple[str, str, bool, bool]:
+    # Analyze the text to choose the modes, and then remove the and qu in a single pass
+    assert caps in caps_modes, f"Error: caps='{caps}' not in {caps_modes}"
+    lower = text.lower() if caps != 'upper' else None
+    modified = None
     if caps_fallback:
-        if caps == 'auto' and text != decode_caps_simple(encode_caps(text, caps)):
-            caps = 'raw'
+        if caps == 'auto' and not is_auto_caps(text, lower):
+            caps = 'modifiers' if len(text) >= min_modifiers_len else 'raw'
             if verbose:
                 print(f"Falling back to caps='{caps}'", file=sys.stderr)
-        if caps == 'raw':
-            if text == text.lower():
+        if caps in ['modifiers', 'raw']:
+            if text == lower:
                 caps = 'lower'
             elif text == text.upper():
                 caps = 'upper'
-    text = encode_caps(text, caps)
+        if caps == 'modifiers':
+            modified = encode_caps_modifiers(text, lower)
+            if modified is None or len(modified) - len(text) > len(text) * max_modifiers_ratio:
+                caps = 'raw'
+                if verbose:
+                    print(f"Falling back to caps='{caps}'", file=sys.stderr)
+    if caps == 'modifiers':
+        text = encode_caps(text, caps) if modified is None else modified
+    else:
+        text = text if caps == 'raw' else text.upper() if caps == 'upper' else lower
 
     if the:
-        theless = remove_the(text)
+        the_str = 'THE' if caps == 'upper' or caps == 'raw' and text == text.upper() else 'the'  # A lowercased text with no cased letters has no the
         if the_fallback:
-            if theless == text:
+            if not regex.search(get_the_encoder_regex(the_str), text, regex.MULTILINE):
                 the = False
-            if the and regex.search('^ |  | $', text, regex.MULTILINE):
+            if the and the_space_pattern.search(text):
                 the = False
                 if verbose:
                     print(f'Falling back to the={the}', file=sys.stderr)
-        if the:
-            text = theless
 
     if quq:
-        quless = encode_quq(text)
+        removed, bad = get_quq_stats(text, caps)
         if quq_fallback:
-            if len(text) - len(quless) < len(get_quq_js_decoder(caps)):
+            if removed < len(get_quq_js_decoder(caps)):
                 quq = False
-            if quq and count_bad_quq(text, caps, verbose):
+            if quq and bad:
                 quq = False
                 if verbose:
+                    print(f'Warning: found {bad} cases of q followed by a non u, or terminal qu', file=sys.stderr)
                     print(f'Falling back to quq={quq}', file=sys.stderr)
-        if quq:
-            text = quless
 
+    encoders = ([get_the_encoder_regex(the_str)] if the else []) + ([quq_encoder_regex] if quq else [])
+    if encoders:  # Groups of unmatched alternatives are substituted with empty strings
+        text = regex.sub('|'.join(encoders), ''.join(f'\\{i}' for i in range(1, 2 * len(encoders) + 1)), text, flags=regex.MULTILINE)
     return text, caps, the, quq
 
 
@@ -154,24 +460,65 @@ def get_js_decoder(text: Optional[str] = None,
                    caps: str = default_caps,
                    the: bool = True,
                    quq: bool = True,
-                   text_var: str = default_vars.text
+                   text_var: str = default_vars.text,
+                   fused: bool = False
                    ) -> str:
     assert caps in caps_modes, f"Error: caps='{caps}' not in {caps_modes}"
     if text is not None:
         text, caps, the, quq = encode_with_fallbacks(text, caps, the, quq)
+    if fused and len(get_quq_variants(caps)) * quq + the + (caps in ['auto', 'simple']) > 1:  # Avoid allocating a new string per pass
+        js_decoder = get_fused_js_decoder(caps, the, quq, text_var)
+        if caps == 'modifiers':
+            js_decoder += f'{text_var}={text_var}{get_caps_modifiers_js_decoder()}\n'
+        return js_decoder
     js_decoder = ''
     if quq:
         js_decoder += get_quq_js_decoder(caps)
     if the:
         the_str = 'THE' if caps == 'upper' else 'the'
-        js_decoder += f".replace(/(^(?!$)| )( |$)/gm,'$1{the_str}$2')"
+        js_decoder += f".replace(/{the_regex}/gm,'$1{the_str}$2')"
     if caps in ['auto', 'simple']:
         js_decoder += f'.replace(/{caps_regex}/gu,m=>m.toUpperCase())'
+    elif caps == 'modifiers':
+        js_decoder += get_caps_modifiers_js_decoder()
     if js_decoder:
         js_decoder = f'{text_var}={text_var}{js_decoder}\n'
     return js_decoder
 
 
+def decode(text: str,
+           caps: str = default_caps,
+           the: bool = True,
+           quq: bool = True,
+           fused: bool = False
+           ) -> str:
+    # Python counterpart of get_js_decoder() for the chosen modes
+    assert caps in caps_modes, f"Error: caps='{caps}' not in {caps_modes}"
+    if fused and len(get_quq_variants(caps)) * quq + the + (caps in ['auto', 'simple']) > 1:
+        text = fused_decode(text, caps, the, quq)
+    else:
+        if quq:
+            text = decode_quq(text, caps)
+        if the:
+            text = decode_the(text, caps)
+        if caps in ['auto', 'simple']:
+            text = decode_caps_simple(text)
+    if caps == 'modifiers':
+        text = decode_caps_modifiers(text)
+    return text
+
+
+def get_expected(text: str, caps: str = default_caps) -> str:
+    # The text as rendered by the decoder, i.e. after the lossy caps modes
+    if caps == 'lower':
+        return text.lower()
+    if caps == 'upper':
+        return text.upper()
+    if caps == 'simple':
+        return decode_caps_simple(text.lower())
+    return text
+
+
 def encode_and_get_js_decoder(text: str,
                               caps: str = default_caps,
                               the: bool = True,
@@ -180,10 +527,11 @@ def encode_and_get_js_decoder(text: str,
                               the_fallback: bool = True,
                               quq_fallback: bool = True,
                               verbose: bool = False,
-                              text_var: str = default_vars.text
+                              text_var: str = default_vars.text,
+                              fused: bool = False
                               ) -> Tuple[str, str]:
     text, caps, the, quq = encode_with_fallbacks(text, caps, the, quq, caps_fallback, the_fallback, quq_fallback, verbose)
-    return text, get_js_decoder(caps=caps, the=the, quq=quq, text_var=text_var)
+    return text, get_js_decoder(caps=caps, the=the, quq=quq, text_var=text_var, fused=fused)
 
 
 def test_quq() -> None:
@@ -203,5 +551,87 @@ def test_quq() -> None:
     print(f'Found {bad} bad qu cases', file=sys.stderr)
 
 
+def test_quq_stats(n: int = 100000, max_len: int = 20, seed: int = 0) -> None:
+    # Compare with roundtripping the whole text
+    rng = Random(seed)
+    chars = "qQuUaB'’ "
+    bad = 0
+    for caps in caps_modes:
+        for _ in range(n // len(caps_modes)):
+            text = ''.join(rng.choice(chars) for _ in range(rng.randint(0, max_len)))
+            enc = encode_quq(text)
+            splits = q_pattern.split(text)
+            recon = q_pattern.split(decode_quq(enc, caps))
+            expected = len(text) - len(enc), sum(a != b for a, b in zip(recon, splits)) + abs(len(recon) - len(splits))
+            stats = get_quq_stats(text, caps)
+            if stats != expected:
+                print(f'caps={caps:>9}: text={text!r} -> stats={stats} expected={expected}', file=sys.stderr)
+                bad += 1
+    print(f'Found {bad} bad qu stats cases', file=sys.stderr)
+
+
+def test_normalize(n: int = 100000, max_len: int = 20, seed: int = 0) -> None:
+    rng = Random(seed)
+    chars = "ab \t\n\r\x85\xa0\u2028\u2029\ufeff\u2014\u2018\u201c\u2026"
+    bad = 0
+    for _ in range(n):
+        text = ''.join(rng.choice(chars) for _ in range(rng.randint(0, max_len)))
+        args = [rng.random() < 0.5 for _ in range(4)]
+        cuts = sorted(rng.randint(0, len(text)) for _ in range(rng.randint(0, 4)))
+        chunks = [text[i:j] for i, j in zip([0] + cuts, cuts + [len(text)])]
+        norm = normalize(text, *args)
+        streamed = ''.join(normalize_chunks(chunks, *args))
+        if streamed != norm:
+            print(f'args={args}: chunks={chunks!r} -> norm={norm!r} streamed={streamed!r}', file=sys.stderr)
+            bad += 1
+    print(f'Found {bad} bad normalize cases', file=sys.stderr)
+
+
+def test_caps_modifiers(n: int = 100000, max_len: int = 20, seed: int = 0) -> None:
+    rng = Random(seed)
+    chars = "aAbBiIqQuUtThHeE1'.!? \n\r\u2029\u0345\u24d0\u01c5\u0130\xdf"
+    bad = 0
+    for _ in range(n):
+        orig = ''.join(rng.choice(chars) for _ in range(rng.randint(0, max_len)))
+        text, caps, the, quq = encode_with_fallbacks(orig, 'modifiers', quq_fallback=False)
+        dec = decode_quq(text, caps) if quq else text
+        if the:
+            dec = decode_the(dec, caps)
+        if caps == 'modifiers':
+            dec = decode_caps_modifiers(dec)
+        elif caps == 'lower':
+            dec = orig.lower()
+        elif caps == 'upper':
+            dec = orig.upper()
+        if dec != orig and caps not in ['lower', 'upper'] and count_bad_quq(orig, caps) == 0:
+            print(f'caps={caps:>9} the={the:d} quq={quq:d}: orig={orig!r} -> text={text!r} -> dec={dec!r}', file=sys.stderr)
+            bad += 1
+    print(f'Found {bad} bad caps modifiers cases', file=sys.stderr)
+
+
+def test_fused(n: int = 100000, max_len: int = 20, seed: int = 0) -> None:
+    rng = Random(seed)
+    chars = "qQuUiItTaB1'’.!? \n\r\v\x85\u2028\u2029\u0345\u24d0"
+    bad = 0
+    for caps in caps_modes:
+        for the, quq in [(False, True), (True, False), (True, True)]:
+            for _ in range(n // len(caps_modes) // 3):
+                text = ''.join(rng.choice(chars) for _ in range(rng.randint(0, max_len)))
+                dec = decode_quq(text, caps) if quq else text
+                if the:
+                    dec = decode_the(dec, caps)
+                if caps in ['auto', 'simple']:
+                    dec = decode_caps_simple(dec)
+                fused = fused_decode(text, caps, the, quq)
+                if fused != dec:
+                    print(f'caps={caps:>6} the={the:d} quq={quq:d}: text={text!r} -> dec={dec!r} fused={fused!r}', file=sys.stderr)
+                    bad += 1
+    print(f'Found {bad} bad fused cases', file=sys.stderr)
+
+
 if __name__ == '__main__':
+    test_normalize()
     test_quq()
+    test_quq_stats()
+    test_caps_modifiers()
+    test_fused()
@@ -1,10 +1,16 @@
+import atexit
 from base64 import b64decode
-from contextlib import ExitStack, redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack, redirect_stdout
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 import os
+import shutil
 import sys
 from tempfile import NamedTemporaryFile
 from time import sleep, time
-from typing import AnyStr, Iterable, Mapping, Optional, overload, TypeVar, Union
+from threading import Lock, Thread
+from typing import Any, AnyStr, Dict, Iterable, Iterator, List, Mapping, Optional, overload, Set, Tuple, TypeVar, Union
 
 try:
     from typing import Literal
@@ -22,26 +28,36 @@ from webdriver_manager.microsoft import EdgeChromiumDriverManager
 from webdriver_manager.firefox import GeckoDriverManager
 
 if not __package__:
-    import default_vars, text_prep, webify
+    import default_vars, engine, reference, text_prep, webify
 else:
     # noinspection PyPackages
-    from . import default_vars, text_prep, webify
+    from . import default_vars, engine, reference, text_prep, webify
 
 
 default_browser = 'chrome'
 default_timeout = 60
+done_poll_interval = 10  # ms. The done flag of ztml(signal_done=True) is polled in the page, as its event listener would not survive document.write() with raw=True
 default_by = By.TAG_NAME
 default_element = 'body'
 webdriver_paths_filename = 'webdriver_paths.txt'
+webdriver_env_var = 'ZTML_{}_WEBDRIVER'  # Path of a preinstalled driver executable, e.g. ZTML_CHROME_WEBDRIVER
+download_env_var = 'ZTML_DOWNLOAD_WEBDRIVER'  # Set to 1 to allow downloading missing drivers with webdriver_manager
+max_retry_delay = 30
+default_max_idle = 4  # Warm sessions kept per browser
+default_max_uses = 100  # Renderings after which a session is recycled, to bound the memory growth of long-lived browsers
 
 
 os.environ['WDM_LOG'] = '0'
-drivers = dict(chrome=[Chrome, chrome, ChromeDriverManager],
-               edge=[Edge, edge, EdgeChromiumDriverManager],
-               firefox=[Firefox, firefox, GeckoDriverManager]
+drivers = dict(chrome=[Chrome, chrome, ChromeDriverManager, 'chromedriver'],
+               edge=[Edge, edge, EdgeChromiumDriverManager, 'msedgedriver'],
+               firefox=[Firefox, firefox, GeckoDriverManager, 'geckodriver']
                )
+resolved_webdrivers: Dict[str, str] = {}
+stale_webdrivers: Set[str] = set()
+resolve_lock = Lock()
 BrowserType = Union[str, WebDriver]
 critical_error_strings = ['executable needs to be', 'unable to find binary', 'unexpectedly']
+mismatch_error_strings = ['session not created', 'only supports']  # Fatal for the driver, but another driver may work
 
 
 FilenameOrBytes = TypeVar('FilenameOrBytes', str, bytes)
@@ -51,8 +67,79 @@ def full_path(filename: str) -> str:
     return f"file:///{os.path.realpath(filename).replace(os.sep, '/')}"
 
 
+class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+
+@contextmanager
+def serve_directory(directory: str) -> Iterator[str]:
+    # Serve a folder over HTTP on a free local port, for pages loading separate files that must not taint the canvas
+    with ThreadingHTTPServer(('localhost', 0), partial(QuietHTTPRequestHandler, directory=directory)) as server:
+        Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            yield f'http://localhost:{server.server_address[1]}/'
+        finally:
+            server.shutdown()
+
+
+def is_executable(path: str) -> bool:
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+def get_cached_webdriver_paths(browser: str) -> List[str]:
+    # Most recent first
+    try:
+        with open(webdriver_paths_filename, encoding='utf8') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    return [path for b, path in (line.split(',', 1) for line in reversed(lines) if ',' in line) if b == browser]
+
+
+def get_webdriver_candidates(browser: str, download: Optional[bool] = None) -> Iterator[str]:
+    # A configured, cached or installed driver, validated locally without network access, and finally a download when enabled.
+    # Drivers which failed to start a session are skipped
+    if download is None:
+        download = os.environ.get(download_env_var, '') not in ['', '0']
+    with resolve_lock:
+        resolved = resolved_webdrivers.get(browser, '')
+    candidates = [resolved, os.environ.get(webdriver_env_var.format(browser.upper()), ''), *get_cached_webdriver_paths(browser), shutil.which(drivers[browser][3]) or '']
+    for path in dict.fromkeys(candidates):
+        if path and path not in stale_webdrivers and is_executable(path):
+            yield path
+    if download:
+        with resolve_lock, redirect_stdout(None):
+            path = drivers[browser][2]().install()
+        folder = os.path.dirname(webdriver_paths_filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(webdriver_paths_filename, 'a', encoding='utf8') as f:
+            f.write(f'{browser},{path}\n')
+        yield path
+
+
+def start_browser(browser: str, service: str, options: Any) -> Optional[WebDriver]:
+    # Return None if the driver does not match the browser, e.g. a driver left behind by a browser update
+    delay = 1
+    while True:
+        try:
+            return drivers[browser][0](service=drivers[browser][1].service.Service(service, log_path=os.devnull), options=options)
+        except WebDriverException as e:
+            msg = e.msg or ''
+            if any(s in msg for s in mismatch_error_strings):
+                print(f'Warning: skipping {service}: {msg.strip()}', file=sys.stderr)
+                return None
+            if any(s in msg for s in critical_error_strings):
+                raise
+            print(e, file=sys.stderr)
+            sleep(delay)  # Back off exponentially, instead of a fixed long wait on transient startup failures
+            delay = min(delay * 2, max_retry_delay)
+
+
 def get_browser(browser: BrowserType,
-                stack: Optional[ExitStack] = None
+                stack: Optional[ExitStack] = None,
+                download: Optional[bool] = None
                 ) -> WebDriver:
     if isinstance(browser, WebDriver):
         return browser
@@ -61,54 +148,139 @@ def get_browser(browser: BrowserType,
     options.add_argument('--no-sandbox')
     if hasattr(options, 'add_experimental_option'):
         options.add_experimental_option('excludeSwitches', ['enable-logging'])
+    for service in get_webdriver_candidates(browser, download):
+        session = start_browser(browser, service, options)
+        if session:
+            with resolve_lock:
+                resolved_webdrivers[browser] = service
+            if stack:
+                session = stack.enter_context(session)
+            return session
+        with resolve_lock:
+            stale_webdrivers.add(service)
+            if resolved_webdrivers.get(browser) == service:
+                del resolved_webdrivers[browser]
+    raise FileNotFoundError(f'Error: No working {drivers[browser][3]} found. Set {webdriver_env_var.format(browser.upper())} to its path, add it to PATH, or set {download_env_var}=1 to download it')
+
+
+def is_alive(browser: WebDriver) -> bool:
     try:
-        with redirect_stdout(None):
-            service = drivers[browser][2]().install()
-        folder = os.path.dirname(webdriver_paths_filename)
-        if folder:
-            os.makedirs(folder, exist_ok=True)
-        with open(webdriver_paths_filename, 'a', encoding='utf8') as f:
-            f.write(f'{browser},{service}\n')
+        browser.execute_script('return 1')
+        return True
+    except WebDriverException:
+        return False
+
+
+def quit_browser(browser: WebDriver) -> None:
+    try:
+        browser.quit()
     except Exception:
-        with open(webdriver_paths_filename, encoding='utf8') as f:
-            for line in reversed(f.read().splitlines()):
-                b, service = line.split(',', 1)
-                if b == browser:
-                    break
-    while isinstance(browser, str):
+        pass
+
+
+class BrowserPool:
+    # Process-wide warm browser sessions, leased per rendering, health-checked on lease and recycled after max_uses
+    def __init__(self, max_idle: int = default_max_idle, max_uses: int = default_max_uses) -> None:
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self.idle: Dict[str, List[WebDriver]] = {}
+        self.uses: Dict[WebDriver, int] = {}
+        self.lock = Lock()
+        atexit.register(self.close)
+
+    def acquire(self, browser: str) -> WebDriver:
+        while True:
+            with self.lock:
+                idle = self.idle.get(browser)
+                session = idle.pop() if idle else None
+            if session is None:
+                session = get_browser(browser)
+                with self.lock:
+                    self.uses[session] = 0
+                return session
+            if is_alive(session):
+                return session
+            self.discard(session)
+
+    def release(self, browser: str, session: WebDriver) -> None:
+        with self.lock:
+            self.uses[session] += 1
+            idle = self.idle.setdefault(browser, [])
+            keep = self.uses[session] < self.max_uses and len(idle) < self.max_idle
+            if keep:
+                idle.append(session)
+        if not keep:
+            self.discard(session)
+
+    def discard(self, session: WebDriver) -> None:
+        with self.lock:
+            self.uses.pop(session, None)
+        quit_browser(session)
+
+    @contextmanager
+    def lease(self, browser: BrowserType) -> Iterator[WebDriver]:
+        if isinstance(browser, WebDriver):  # Sessions passed by the caller are managed by the caller
+            yield browser
+            return
+        session = self.acquire(browser)
         try:
-            browser = drivers[browser][0](service=drivers[browser][1].service.Service(service, log_path=os.devnull), options=options)
-        except WebDriverException as e:
-            if any(s in e.msg for s in critical_error_strings):
-                raise
-            print(e, file=sys.stderr)
-            sleep(30)
-    if stack:
-        browser = stack.enter_context(browser)
-    return browser
+            yield session
+        finally:
+            self.release(browser, session)
+
+    def close(self) -> None:
+        with self.lock:
+            sessions = list(self.uses)
+            self.uses.clear()
+            self.idle.clear()
+        for session in sessions:
+            quit_browser(session)
+
+
+browser_pool = BrowserPool()
+
+
+def get_timings(browser: WebDriver, timings_var: str = default_vars.timings) -> Dict[str, float]:
+    # Decoder stage durations in ms, as measured by ztml(timing=True)
+    return browser.execute_script(f'return self.{timings_var}||{{}}')
 
 
 @overload
 def render_html(file: FilenameOrBytes, by: str = ..., element: str = ...,
                 raw: bool = ..., image: Literal[True] = ...,
-                browser: str = ..., timeout: int = ..., content_var: str = ...
+                browser: str = ..., timeout: int = ..., content_var: str = ...,
+                min_len: int = ..., timing: Literal[False] = ...,
+                done_var: str = ...
                 ) -> Optional[bytes]: ...
 
 
 @overload
 def render_html(file: FilenameOrBytes, by: str = ..., element: str = ...,
                 raw: bool = ..., image: Literal[False] = ...,
-                browser: str = ..., timeout: int = ..., content_var: str = ...
+                browser: str = ..., timeout: int = ..., content_var: str = ...,
+                min_len: int = ..., timing: Literal[False] = ...,
+                done_var: str = ...
                 ) -> Optional[str]: ...
 
 
 @overload
 def render_html(file: FilenameOrBytes, by: str = ..., element: str = ...,
                 raw: bool = ..., image: bool = ...,
-                browser: str = ..., timeout: int = ..., content_var: str = ...
+                browser: str = ..., timeout: int = ..., content_var: str = ...,
+                min_len: int = ..., timing: Literal[False] = ...,
+                done_var: str = ...
                 ) -> Optional[AnyStr]: ...
 
 
+@overload
+def render_html(file: FilenameOrBytes, by: str = ..., element: str = ...,
+                raw: bool = ..., image: bool = ...,
+                browser: str = ..., timeout: int = ..., content_var: str = ...,
+                min_len: int = ..., timing: Literal[True] = ...,
+                done_var: str = ...
+                ) -> Tuple[Optional[AnyStr], Dict[str, float]]: ...
+
+
 def render_html(file,
                 by=default_by,
                 element=default_element,
@@ -116,28 +288,36 @@ def render_html(file,
                 image=False,
                 browser=default_browser,
                 timeout=default_timeout,
-                content_var=''
+                content_var='',
+                min_len=0,
+                timing=False,
+                done_var=''
                 ):
     assert not raw or not image
     if not by:
         by = default_by
     if not element:
         element = default_element
-    with ExitStack() as stack:
-        browser = get_browser(browser, stack)
+    if browser == engine.browser_name:  # Run the JS in an embedded engine without a browser
+        return engine.render_html(file, by, element, raw, image, timeout, content_var, timing, done_var)
+    with browser_pool.lease(browser) as browser:
         if isinstance(file, str):
             filename = file
         else:
             with NamedTemporaryFile(suffix='.html', delete=False) as f:  # See https://github.com/python/cpython/issues/88221
                 f.write(file)
                 filename = f.name
-        browser.get(full_path(filename))
+        browser.get(filename if filename.startswith(('http://', 'https://')) else full_path(filename))
         if isinstance(file, bytes):
             try:
                 os.remove(filename)
             except PermissionError:
                 pass
         try:
+            if done_var:  # Await the completion flag of ztml(signal_done=True), so that the content below is read once.
+                # Poll the flag in the page rather than listen to the event, as with raw=True document.write() erases the window listeners
+                browser.set_script_timeout(timeout)
+                browser.execute_async_script(f'let done=arguments[0],f=()=>self.{done_var}?done():setTimeout(f,{done_poll_interval});f()')
             wait = WebDriverWait(browser, timeout)
             if image:
                 if by == By.TAG_NAME and element == 'body':
@@ -151,25 +331,33 @@ def render_html(file,
                                           .get_property('src'))
                 assert isinstance(data_url, str), type(data_url)
                 if ';base64,' in data_url:
-                    return b64decode(data_url.split(';base64,', 1)[1].split('"', 1)[0], validate=True)
-                image_data = browser.execute_script(f'return {content_var or default_vars.bytearray}')
-                if isinstance(image_data, dict):  # Needed for or Firefox, see: https://github.com/SeleniumHQ/selenium/issues/11070
-                    image_data = [v for k, v in sorted(image_data.items(), key=lambda x: int(x[0]))]
-                return bytes(image_data)
-            if raw:
-                sleep(0.1)
-                get_text = lambda x: x.execute_script(f'return {content_var or default_vars.text}')
+                    rendered = b64decode(data_url.split(';base64,', 1)[1].split('"', 1)[0], validate=True)
+                else:
+                    image_data = browser.execute_script(f'return {content_var or default_vars.bytearray}')
+                    if isinstance(image_data, dict):  # Needed for or Firefox, see: https://github.com/SeleniumHQ/selenium/issues/11070
+                        image_data = [v for k, v in sorted(image_data.items(), key=lambda x: int(x[0]))]
+                    rendered = bytes(image_data)
             else:
-                get_text = lambda x: x.find_element(by, element).get_property('innerText')
-            try:
-                text = wait.until(get_text)
-            except JavascriptException:
-                sleep(1)
-                text = wait.until(get_text)
-            assert isinstance(text, str), type(text)
-            return text
+                if raw:
+                    if not done_var:
+                        sleep(0.1)
+                    get_text = lambda x: x.execute_script(f'return {content_var or default_vars.text}')
+                else:
+                    def get_text(x: WebDriver) -> Union[str, bool]:
+                        text = x.find_element(by, element).get_property('innerText')
+                        return len(text) >= min_len and text  # Wait for all segments of progressive rendering
+                try:
+                    rendered = wait.until(get_text)
+                except JavascriptException:
+                    if not done_var:
+                        sleep(1)
+                    rendered = wait.until(get_text)
+                assert isinstance(rendered, str), type(rendered)
+            if timing:
+                return rendered, get_timings(browser)
+            return rendered
         except TimeoutException:
-            return None
+            return (None, {}) if timing else None
         except Exception:
             print(f'\nError: {browser.name} failed on {full_path(filename)}', file=sys.stderr)
             raise
@@ -200,20 +388,24 @@ def validate_html(file: FilenameOrBytes,  # Don't use AnyStr as it does not have
                   unicode_A: int = 0,
                   ignore_regex: str = '',
                   content_var: str = '',
+                  progressive: bool = False,
+                  timing: bool = False,
+                  done_var: str = '',
                   verbose: bool = True
                   ) -> Optional[bool]:
     image = isinstance(data, bytes)
     assert data, 'Error: Cannot validate against empty data'
-    rendered = render_html(file, by, element, raw, image, browser, timeout, content_var)
+    if not image:
+        data = text_prep.get_expected(data, caps)
+    rendered = render_html(file, by, element, raw, image, browser, timeout, content_var, len(data) * progressive, timing, done_var)
+    if timing:
+        rendered, timings = rendered
+        if verbose and timings:
+            name = browser if isinstance(browser, str) else browser.name
+            print(f"Decoding stages in {name} (ms): {' '.join(f'{stage}={duration:.1f}' for stage, duration in timings.items())}", file=sys.stderr)
     if rendered is None:
         return None
     if not image:
-        if caps == 'lower':
-            data = data.lower()
-        elif caps == 'upper':
-            data = data.upper()
-        elif caps == 'simple':
-            data = text_prep.decode_caps_simple(data.lower())
         if not raw:
             if unicode_A:
                 rendered = regex.sub(r'[^\p{Z}\p{C}]', lambda m: chr(ord(m[0]) - unicode_A + 65 + (6 if ord(m[0]) - unicode_A + 65 > 90 else 0)), rendered)
@@ -242,6 +434,8 @@ def validate_files(filenames: Mapping[str, str],
                    ignore_regex: str = '',
                    content_var: str = '',
                    validate: bool = True,
+                   workers: int = 1,
+                   done_var: str = '',
                    verbose: bool = True
                    ) -> bool:
     error = False
@@ -249,9 +443,27 @@ def validate_files(filenames: Mapping[str, str],
         browsers = list(drivers)
     elif isinstance(browsers, (str, WebDriver)):
         browsers = [browsers]
-    with ExitStack() as stack:
-        if validate:
-            browsers = [get_browser(browser, stack) for browser in browsers]
+    if any(isinstance(browser, WebDriver) for browser in browsers):
+        workers = 1  # A caller session cannot be shared across threads
+
+    def validate_with(filename: str, data: AnyStr, raw: bool, browser: BrowserType) -> Tuple[Optional[bool], str, float]:
+        if browser == reference.browser_name:  # Decode in Python without a browser
+            start_time = time()
+            return reference.validate(filename, data, caps, verbose=verbose), browser, time() - start_time
+        if browser == engine.browser_name:
+            start_time = time()
+            return validate_html(filename, data, caps, by, element, raw, browser, timeout, unicode_A, ignore_regex, content_var,
+                                 done_var=done_var, verbose=verbose), browser, time() - start_time
+        with browser_pool.lease(browser) as session:
+            start_time = time()
+            valid = validate_html(filename, data, caps, by, element,
+                                  raw, session, timeout, unicode_A,
+                                  ignore_regex, content_var,
+                                  done_var=done_var, verbose=verbose)
+            return valid, session.name, time() - start_time
+
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        results = []
         raw_size = None
         no_overhead_size = None
         for label, filename in sorted(filenames.items(), key=lambda x: (x[0] != 'raw', x[0] != 'base64_html')):
@@ -272,6 +484,7 @@ def validate_files(filenames: Mapping[str, str],
             if not image and isinstance(data, bytes):
                 data = text_prep.normalize(data.decode(), reduce_whitespace, unix_newline, fix_punct, remove_bom)  # Assumes raw text file is utf8. Otherwise, pass it as a data argument
 
+            line = None
             if verbose:
                 size = os.path.getsize(filename)
                 if label == 'base64_html':
@@ -297,23 +510,28 @@ def validate_files(filenames: Mapping[str, str],
                 kb = size / 1024
                 if kb >= 0.1:
                     stats = f' = {round(kb, 1):,} kB{stats}'
-                print(f"{full_path(filename)} {size:,} B{stats}", end='' if validate and ext == 'html' and label != 'raw' else None, file=sys.stderr)
+                line = f"{full_path(filename)} {size:,} B{stats}"
 
+            futures = []
             if validate and ext == 'html' and label != 'raw':
-                for i, browser in enumerate(browsers):
-                    start_time = time()
-                    valid = validate_html(filename, data, caps, by, element,
-                                          raw, browser, timeout, unicode_A,
-                                          ignore_regex, content_var, verbose)
-                    assert valid is not False, filename
-                    if not valid:
-                        error = True
-                    if verbose:
-                        if i == 0:
-                            print(f' rendering secs:', end='', file=sys.stderr)
-                        print(f' {browser.name}=' + (f'{time() - start_time :.1f}' if valid else f'{timeout}(TIMEOUT)'), end='', file=sys.stderr)
+                futures = [executor.submit(validate_with, filename, data, raw, browser) for browser in browsers]
+            results.append((filename, line, futures))
+
+        # Report in order, while later documents are still validating on other workers
+        for filename, line, futures in results:
+            if line is not None:
+                print(line, end='' if futures else None, file=sys.stderr)
+            for i, future in enumerate(futures):
+                valid, name, secs = future.result()
+                assert valid is not False, filename
+                if not valid:
+                    error = True
                 if verbose:
-                    print(file=sys.stderr)
+                    if i == 0:
+                        print(f' rendering secs:', end='', file=sys.stderr)
+                    print(f' {name}=' + (f'{secs:.1f}' if valid else f'{timeout}(TIMEOUT)'), end='', file=sys.stderr)
+            if verbose and futures:
+                print(file=sys.stderr)
         if verbose and validate:
             print('Note: above rendering times from Selenium are much longer than actual browser rendering.', file=sys.stderr)
     return error
@@ -5,6 +5,10 @@ This is far from being a full-fledged JS minifier, and only addresses specific f
 (with defaults tuned for the author's own hand-minified use cases)
 You may be able to reduce your script further with JS minifiers and packers (see references),
 however these might not be compatible with ZTML (especially when using the non-utf8 crEnc).
+Whitespace and comments are stripped with a minimal tokenizer that keeps template literals and regular expressions intact,
+and keeps newlines where automatic semicolon insertion may depend on them.
+A simple JSCrush-style packer is also included, which leaves large literals (i.e. the payload) out of the packed code
+and bootstraps with eval. It is only used when this makes the output smaller.
 
 Warnings:
 1. The two-parameter aliases would miss substitutions involving tag function syntax, i.e.
@@ -19,6 +23,9 @@ Warnings:
 4. You may need to set replace_quoted=False if you do not want e.g. all 'length', "Length"
    to be replaced by: L
 5. Aliases to be used in other aliases e.g. document, should be specified before the latter.
+6. Automatically mined aliases (auto_aliases=True) are restricted to unbound global names and property accesses
+   that do not appear in strings, regular expressions or comments, and are aimed at generated code.
+   Name bindings are detected heuristically, so this is disabled by default for general scripts.
 
 References:
 https://github.com/google/closure-compiler
@@ -35,9 +42,17 @@ https://github.com/mishoo/UglifyJS
 """
 
 
+from collections import Counter
+from itertools import chain
 import re
 import sys
-from typing import AnyStr
+from typing import AnyStr, Iterator, List, Set, Tuple
+
+if not __package__:
+    import default_vars
+else:
+    # noinspection PyPackages
+    from . import default_vars
 
 
 raw_extensions = ['htm', 'html', 'svg']
@@ -62,7 +77,23 @@ N = speechSynthesis
 O = setTimeout
 '''
 
-literals_regex = rf'(`(?:\\.|[^`\\])*`)'
+literals_regex = rf'(`[^`\\]*(?:\\.[^`\\]*)*`)'  # Unrolled loop to avoid per-character alternation on large literals
+
+regex_literal_regex = r'(?P<regex>/(?![*/])(?:[^/\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/\w*)|'
+tokens_regex = (r'(?P<template>`[^`\\]*(?:\\.[^`\\]*)*`)'
+                r'|(?P<string>\'[^\'\\\n]*(?:\\.[^\'\\\n]*)*\'|"[^"\\\n]*(?:\\.[^"\\\n]*)*")'
+                r'|(?P<comment>//[^\n]*|/\*[\s\S]*?\*/)|{regex}'
+                r'(?P<number>\.?\d[\w.]*)|(?P<name>[^\W\d][\w$]*|\$[\w$]*)|(?P<space>\s+)'
+                r'|(?P<punct>\.\.\.|\?\.(?!\d)|=>|[=!]==?|[-+*/%&|^<>]=|&&|\|\||\?\?|\+\+|--|\*\*|.)')
+tokens_pattern = re.compile(tokens_regex.format(regex=''))
+operand_tokens_pattern = re.compile(tokens_regex.format(regex=regex_literal_regex))  # Where an operand is expected, / starts a regular expression
+substitution_pattern = re.compile(r'(?<!\\)(?:\\\\)*\${')  # Unescaped ${ in a template literal
+js_keywords = set('''await break case catch class const continue debugger default delete do else enum eval export extends false
+finally for function if import in instanceof let new null of return static super switch this throw true try typeof var
+void while with yield arguments async get set'''.split())
+operand_keywords = {'case', 'delete', 'do', 'else', 'in', 'instanceof', 'new', 'of', 'return', 'throw', 'typeof', 'void', 'yield'}
+binding_keywords = {'catch', 'class', 'const', 'for', 'function', 'let', 'var'}
+restricted_keywords = {'break', 'continue', 'return', 'throw', 'yield'}  # Which cannot be followed by a newline without ending the statement
 
 
 def escape(s: AnyStr, escape_nul: bool = False) -> AnyStr:
@@ -86,16 +117,194 @@ def escape(s: AnyStr, escape_nul: bool = False) -> AnyStr:
 def safe_encode(s: str, encoding: str, get_back_unused: bool = False) -> bytes:
     encoding = encoding.lower()
     out = s.encode(encoding, 'strict' if encoding.replace('-', '') == 'utf8' else 'backslashreplace')
-    out = re.sub(rb'\\U000?([\da-f]{5,6})', rb'\\u{\1}', out)
+    out = re.sub(rb'\\U0(?:00([\da-f]{5})|0([\da-f]{6}))', rb'\\u{\1\2}', out)  # \U escapes always have 8 digits, which may be followed by literal digits
     if get_back_unused and encoding == 'cp1252':
         out = out.replace(b'\\x81', b'\x81').replace(b'\\x8d', b'\x8d').replace(b'\\x8f', b'\x8f').replace(b'\\x90', b'\x90').replace(b'\\x9d', b'\x9d')  # These actually do not require escaping in HTML
     return out
 
 
+def get_js_mark(stage: str) -> str:
+    return f"performance.mark('{stage}')\n"
+
+
+def get_js_measure(stage: str, timings_var: str = default_vars.timings) -> str:
+    # Accumulate the duration since the stage mark in a global object, e.g. over progressive segments
+    return f"{timings_var}.{stage}=({timings_var}.{stage}||0)+performance.measure('{stage}','{stage}').duration\n"
+
+
+def get_js_signal_done(done_var: str = default_vars.done) -> str:
+    # Set a global flag to the completion time, and dispatch a window event of the same name, so that validation can await the rendering
+    return f"self.{done_var}=performance.now();dispatchEvent(new Event('{done_var}'))"
+
+
+def get_js_timed(script: AnyStr, stage: str, timings_var: str = default_vars.timings) -> AnyStr:
+    # Wrap a synchronous decoder stage with performance marks
+    if not script.strip():
+        return script
+    mark = get_js_mark(stage)
+    newline = '\n'
+    measure = get_js_measure(stage, timings_var)
+    if isinstance(script, bytes):
+        mark = mark.encode()
+        newline = newline.encode()
+        measure = measure.encode()
+    return mark + script.strip() + newline + measure
+
+
 def get_len(s: AnyStr, encoding: str) -> int:
     return len(safe_encode(s, encoding) if isinstance(s, str) else s)
 
 
+def tokenize(script: str) -> List[Tuple[str, str]]:
+    # A minimal JS tokenizer returning (kind, text) pairs, distinguishing regular expressions from divisions by context
+    tokens = []
+    prev = None
+    pos = 0
+    while pos < len(script):
+        operand = prev is None or prev[0] == 'punct' and prev[1] not in ')]}' or prev[0] == 'name' and prev[1] in operand_keywords
+        match = (operand_tokens_pattern if operand else tokens_pattern).match(script, pos)
+        token = match.lastgroup, match[0]
+        tokens.append(token)
+        if token[0] not in ['space', 'comment']:
+            prev = token
+        pos = match.end()
+    return tokens
+
+
+def get_text_encoding(encoding: str) -> str:
+    return 'utf8' if encoding.lower().replace('-', '') == 'utf8' else 'l1'  # Single-byte encodings map each byte to a character
+
+
+def needs_space(prev: Tuple[str, str], token: Tuple[str, str]) -> bool:
+    return (re.match(r'[\w$\\]', token[1]) and (re.search(r'[\w$]$', prev[1]) or prev[0] == 'regex')
+            or prev[0] == 'number' and token[1][0] == '.'
+            or prev[1][-1] in '+-' and token[1][0] == prev[1][-1]
+            or prev[1][-1] == '/' and token[1][0] in '/*')
+
+
+def needs_newline(prev: Tuple[str, str], token: Tuple[str, str]) -> bool:
+    # Keep newlines that automatic semicolon insertion may depend on, i.e. unless the previous token cannot end
+    # a statement, or the next token continues the statement anyway
+    if prev[0] == 'name':
+        continues = prev[1] in operand_keywords - restricted_keywords
+    else:
+        continues = prev[0] == 'punct' and prev[1] not in [')', ']', '}', '++', '--']
+    if prev[1] == '}' and (token[0] == 'template' or token[1] in ['(', '[', '+', '-']):
+        return True  # An arrow function body cannot be called, indexed or added to, so these start a new statement after it
+    return not continues and not (token[0] == 'template' or token[0] == 'punct' and token[1] not in ['{', '!', '~', '++', '--'])
+
+
+def minify(script: AnyStr, encoding: str = 'utf8') -> AnyStr:
+    # Token-aware stripping of whitespace and comments, leaving template literals, strings and regular expressions intact
+    is_bytes = isinstance(script, bytes)
+    text_encoding = get_text_encoding(encoding)
+    text = script.decode(text_encoding) if is_bytes else script
+    out = []
+    prev = None
+    gap = ''
+    for token in tokenize(text):
+        if token[0] in ['space', 'comment']:
+            gap += token[1] if token[0] == 'space' or token[1][:2] == '/*' else ' '
+            continue
+        if prev is not None and gap:
+            if '\n' in gap and needs_newline(prev, token):
+                out.append('\n')
+            elif needs_space(prev, token):
+                out.append(' ')
+        out.append(token[1])
+        prev = token
+        gap = ''
+    out = ''.join(out)
+    return out.encode(text_encoding) if is_bytes else out
+
+
+def get_names(tokens: List[Tuple[str, str]]) -> Set[str]:
+    # Names in code and in template literal substitutions, which new global names should avoid
+    names = {text for kind, text in tokens if kind == 'name'} | js_keywords
+    for kind, text in tokens:
+        if kind == 'template':
+            for expr in re.findall(r'(?<!\\)\${([^}]*)}', text):
+                names.update(re.findall(r'[^\W\d][\w$]*', expr))
+    return names
+
+
+def get_free_names(taken: Set[str]) -> Iterator[str]:
+    letters = [chr(c) for c in [*range(65, 91), *range(97, 123)]]
+    names = chain(letters, (a + b for a in letters for b in letters))  # Two letters are needed e.g. for many progressive segments
+    return (name for name in names if name not in taken and name not in js_keywords)
+
+
+def mine_aliases(script: AnyStr,
+                 aliases: str = default_aliases,
+                 replace_quoted: bool = True,
+                 min_cnt: int = 2,
+                 ) -> str:
+    # Find recurring global names and property accesses in code, and return new aliases in the format of default_aliases
+    if isinstance(script, bytes):
+        script = script.decode('l1')  # Only the ASCII structure matters here
+    tokens = tokenize(script)
+    code = [token for token in tokens if token[0] not in ['space', 'comment', 'template']]
+    taken = get_names(tokens)
+    taken.update(alias.split('=', 1)[0].strip() for alias in aliases.strip().splitlines())
+    opaque = set()  # Words that substitutions could hit inside strings, regular expressions and comments
+    quoted = Counter()
+    for kind, text in tokens:
+        if kind == 'string' and re.fullmatch(r'.\w+.', text):
+            quoted[text[1:-1]] += 1
+        elif kind in ['string', 'regex', 'comment']:
+            opaque.update(re.findall(r'\w+', text))
+
+    refs = Counter()
+    props = Counter()
+    unsafe = set()
+    openers = []
+    for i, (kind, text) in enumerate(code):
+        prev = code[i - 1][1] if i else ''
+        before_prev = code[i - 2][1] if i > 1 else ''
+        following = code[i + 1][1] if i + 1 < len(code) else ''
+        if kind == 'punct' and text in '([{':
+            openers.append(i)
+        elif kind == 'punct' and text in ')]}' and openers:
+            start = openers.pop()
+            before = [code[j][1] for j in range(max(start - 2, 0), start)]
+            if text == ')' and following == '=>' or text != ')' and following == '=' or before[-1:] in [['catch'], ['function']] or before[:1] == ['function']:
+                unsafe.update(code[j][1] for j in range(start, i) if code[j][0] == 'name' and code[j - 1][1] not in ['.', '?.'])  # Parameters and destructuring
+        elif kind == 'name':
+            if prev == '.':
+                props[text] += 1
+            elif prev == '?.':
+                unsafe.add(text)
+            else:
+                refs[text] += 1
+                if following in ['=', '=>', ':', '++', '--'] or prev in ['++', '--'] or prev in binding_keywords or before_prev == 'for':
+                    unsafe.add(text)
+
+    candidates = []
+    for name, cnt in refs.items():
+        if name not in props and name not in quoted and name not in opaque and name not in unsafe and name not in js_keywords and '$' not in name and cnt >= min_cnt:
+            candidates.append((name, cnt, 0))
+    for name, cnt in props.items():
+        if name not in opaque and name not in unsafe and '$' not in name:
+            cnt_quoted = quoted[name] * replace_quoted
+            if cnt + cnt_quoted >= min_cnt:
+                candidates.append((f"'{name}'", cnt, cnt_quoted))
+
+    def get_saving(long: str, cnt: int, cnt_quoted: int, short_len: int) -> int:
+        if long[0] == "'":
+            return cnt * (len(long) - 3 - short_len) + cnt_quoted * (len(long) - short_len) - short_len - len(long) - 2
+        return cnt * (len(long) - short_len) - short_len - len(long) - 2
+
+    shorts = get_free_names(taken)
+    short = next(shorts, None)
+    out = []
+    for long, cnt, cnt_quoted in sorted(candidates, key=lambda x: -get_saving(*x, short_len=1)):
+        if short is None or get_saving(long, cnt, cnt_quoted, len(short)) <= 0:
+            break
+        out.append(f'{short} = {long}')
+        short = next(shorts, None)
+    return '\n'.join(['', *out, '']) * bool(out)
+
+
 def uglify(script: AnyStr,
            aliases: str = default_aliases,
            replace_quoted: bool = True,
@@ -103,8 +312,18 @@ def uglify(script: AnyStr,
            prevent_grow: bool = True,
            add_used_aliases: bool = True,
            encoding: str = 'utf8',
+           auto_aliases: bool = False,
            ) -> AnyStr:
-    orig_len = get_len(script, encoding)
+    # Literal spans are located once, substitutions are only applied to the code parts in between,
+    # and sizes are computed incrementally, so that large payload literals do not make this quadratic.
+    # Aliases are still applied one by one, as a single alternation pass would change the output:
+    # the aliases see the previous substitutions (e.g. C(document.body,x) must become C(B,x), while a combined pattern would consume the argument),
+    # and the min_cnt and prevent_grow decisions depend on the script after the previous aliases.
+    # This only scans the code parts, so the cost does not depend on the size of the payload
+    literals_pattern = safe_encode(literals_regex, encoding) if isinstance(script, bytes) else literals_regex
+    parts = re.split(literals_pattern, script)
+    lens = [get_len(part, encoding) for part in parts]
+    orig_len = script_len = sum(lens)
     shorts = set()
     for alias in reversed(aliases.strip().splitlines()):
         alias = alias.replace(' ', '')
@@ -139,29 +358,140 @@ def uglify(script: AnyStr,
                 short = safe_encode(short, encoding)
             else:
                 short = lambda x, short=short: safe_encode(short(x), encoding)
-        sub = script[:0]
+        sub_parts = parts[:]
+        sub_lens = lens[:]
         cnt = 0
-        parts = re.split(safe_encode(literals_regex, encoding) if isinstance(script, bytes) else literals_regex, script)
-        for i, part in enumerate(parts):
-            if i % 2 == 0:
-                part, c = re.subn(long, short, part)
+        for i in range(0, len(parts), 2):
+            part, c = re.subn(long, short, parts[i])
+            if c:
+                sub_parts[i] = part
+                sub_lens[i] = get_len(part, encoding)
                 cnt += c
-            sub += part
         if cnt >= min_cnt:
             if add_used_aliases:
                 alias += '\n'
-                if isinstance(sub, bytes):
+                changes_literals = '`' in alias  # Rare case where the alias itself may change the literal spans
+                if isinstance(script, bytes):
                     alias = safe_encode(alias, encoding)
-                if alias not in sub:
-                    sub = alias + sub.lstrip()
-            if not prevent_grow or get_len(sub, encoding) < get_len(script, encoding):
-                script = sub
-    new_len = get_len(script, encoding)
-    if new_len > orig_len:
-        print(f'Warning: uglified size increased: {new_len} B > {orig_len} B', file=sys.stderr)
+                if changes_literals:
+                    sub = script[:0].join(sub_parts)
+                    if alias not in sub:
+                        sub_parts = re.split(literals_pattern, alias + sub.lstrip())
+                        sub_lens = [get_len(part, encoding) for part in sub_parts]
+                elif not any(alias in part for part in sub_parts[::2]):  # Cannot span parts, as these are delimited by `. Literals may hold aliases of their own, e.g. a worker script
+                    sub_parts[0] = alias + sub_parts[0].lstrip()  # Following part (if any) starts with `
+                    sub_lens[0] = get_len(sub_parts[0], encoding)
+            sub_len = sum(sub_lens)
+            if not prevent_grow or sub_len < script_len:
+                parts = sub_parts
+                lens = sub_lens
+                script_len = sub_len
+    script = script[:0].join(parts)
+    if auto_aliases:
+        mined_aliases = mine_aliases(script, aliases, replace_quoted, min_cnt)
+        if mined_aliases:
+            script = uglify(script, mined_aliases, replace_quoted, min_cnt, prevent_grow, add_used_aliases, encoding)
+            script_len = get_len(script, encoding)
+    if script_len > orig_len:
+        print(f'Warning: uglified size increased: {script_len} B > {orig_len} B', file=sys.stderr)
     return script
 
 
+def crush(text: str, tokens: str, max_len: int = 32) -> Tuple[str, str]:
+    # Greedy JSCrush-style substitution of recurring substrings with unused characters.
+    # Each step replaces a substring with a token and appends the token and the substring,
+    # so that splitting on the token, popping the substring and joining reverses it
+    used = ''
+    for token in tokens:
+        if token in text:
+            continue
+        counts = Counter(text[i : i + length] for length in range(2, max_len + 1) for i in range(len(text) - length + 1))
+        best_gain = 0
+        for sub, cnt in sorted(counts.items(), key=lambda x: -(x[1]-1) * len(x[0])):
+            if (cnt-1) * len(sub) - cnt - 2 <= best_gain:
+                break
+            cnt = text.count(sub)
+            gain = (cnt-1) * len(sub) - cnt - 2
+            if gain > best_gain:
+                best_gain = gain
+                best_sub = sub
+        if not best_gain:
+            break
+        text = text.replace(best_sub, token) + token + best_sub
+        used = token + used
+    return text, used
+
+
+def pack(script: AnyStr,
+         encoding: str = 'utf8',
+         min_literal_len: int = 64,
+         ) -> AnyStr:
+    # Self-extracting packing of the code with eval. Large string literals (i.e. payloads) are not packed,
+    # but are rather assigned to variables beforehand. Templates with substitutions are kept in place,
+    # as these may reference variables which are only defined later. Returns the packed script only if it is smaller
+    is_bytes = isinstance(script, bytes)
+    text_encoding = get_text_encoding(encoding)
+    text = script.decode(text_encoding) if is_bytes else script
+    tokens = tokenize(text)
+    free_names = get_free_names(get_names(tokens))
+    header = ''
+    code = ''
+    prev = None
+    for kind, token in tokens:
+        tagged = prev is not None and (prev[0] == 'name' and prev[1] not in js_keywords or prev[1] in ')]' or prev[0] == 'template')
+        if (kind == 'string' or kind == 'template' and not tagged and not substitution_pattern.search(token)) and (len(token) >= min_literal_len or '\0' in token):
+            name = next(free_names)
+            header += f'{name}={token}\n'
+            token = name
+        code += token
+        if kind not in ['space', 'comment']:
+            prev = kind, token
+    packed_var = next(free_names)
+    token_var = next(free_names)
+    unused = [chr(c) for c in range(32, 127) if chr(c) not in '\\`$'] + [chr(c) for c in range(1, 32) if chr(c) not in '\n\r']
+    packed, used = crush(code.strip(), ''.join(unused))
+    out = f'{header}{packed_var}=`{escape(packed)}`\nfor({token_var} of`{used}`)with({packed_var}.split({token_var})){packed_var}=join(pop())\neval({packed_var})\n'
+    if is_bytes:
+        out = out.encode(text_encoding)
+    return out if get_len(out, encoding) < get_len(script, encoding) else script
+
+
+def split_decoder(script: AnyStr,
+                  encoding: str = 'utf8',
+                  func_name: str = default_vars.shared_decoder,
+                  ) -> Tuple[AnyStr, AnyStr]:
+    # Split the script into a generic decoder function, which can be shared by many pages and cached,
+    # and a call passing the page-specific literals (payload, lengths, indices, charsets, offsets) as arguments.
+    # Every literal gets its own argument, even if repeated, so that the decoder does not depend on coinciding values
+    is_bytes = isinstance(script, bytes)
+    text_encoding = get_text_encoding(encoding)
+    text = script.decode(text_encoding) if is_bytes else script
+    tokens = tokenize(text)
+    names = get_names(tokens)
+    assert func_name not in names, f'Error: {func_name} is already used in script'
+    params_var = next(get_free_names(names))
+    significant = [i for i, (kind, _) in enumerate(tokens) if kind not in ['space', 'comment']]
+    params = []
+    code = ''
+    for j, i in enumerate(significant):
+        kind, token = tokens[i]
+        prev = tokens[significant[j - 1]] if j else ('', '')
+        following = tokens[significant[j + 1]][1] if j + 1 < len(significant) else ''
+        tagged = prev[0] == 'name' and prev[1] not in js_keywords or prev[1] in ')]' or prev[0] == 'template'
+        is_key = prev[1] in '{,' and following == ':'
+        if (kind in ['number', 'string'] or kind == 'template' and not tagged and not substitution_pattern.search(token)) and not is_key:
+            token = f'{params_var}[{len(params)}]'
+            params.append(tokens[i][1])
+        code += ''.join(token for _, token in tokens[significant[j - 1] + 1 : i]) if j else ''
+        code += token
+    decoder = f'{func_name}=(...{params_var})=>{{{code.strip()}}}\n'
+    call = f"{func_name}({','.join(params)})"
+    if is_bytes:
+        decoder = decoder.encode(text_encoding)
+        call = call.encode(text_encoding)
+    return decoder, call
+
+
 def html_wrap(script: AnyStr,
               aliases: str = default_aliases,
               replace_quoted: bool = True,
@@ -171,6 +501,9 @@ def html_wrap(script: AnyStr,
               encoding: str = 'utf8',
               mobile: bool = False,
               title: str = '',
+              auto_aliases: bool = False,
+              pack_js: bool = False,
+              src: str = '',
               ) -> AnyStr:
     html_lang = f'<html lang={lang}>' * bool(lang)
     encoding = encoding.lower()
@@ -180,7 +513,8 @@ def html_wrap(script: AnyStr,
         encoding = 'l1'  # HTML5 treats these the same
     mobile_meta = '<meta name=viewport content="width=device-width,initial-scale=1">' * mobile
     title_element = f'<title>{title}</title>' * bool(title)
-    html_header = f'<!DOCTYPEhtml>{html_lang}<meta charset={encoding}>{mobile_meta}{title_element}<b><script>'
+    src_script = f'<script src={src}></script>' * bool(src)
+    html_header = f'<!DOCTYPEhtml>{html_lang}<meta charset={encoding}>{mobile_meta}{title_element}<b>{src_script}<script>'
     html_footer = '</script>'
     sep = ''
     if isinstance(script, bytes):
@@ -188,5 +522,46 @@ def html_wrap(script: AnyStr,
         html_footer = safe_encode(html_footer, encoding)
         sep = safe_encode(sep, encoding)
     if aliases:
-        script = uglify(script, aliases, replace_quoted, min_cnt, prevent_grow, encoding=encoding)
+        script = uglify(script, aliases, replace_quoted, min_cnt, prevent_grow, encoding=encoding, auto_aliases=auto_aliases)
+    if pack_js:
+        script = pack(script, encoding)
     return sep.join([html_header, script.strip(), html_footer])
+
+
+def test() -> None:
+    assert minify('f=()=>{}\n(g=1)\nh=()=>{}\n[1].map(f)\nk={}\n`x`') == 'f=()=>{}\n(g=1)\nh=()=>{}\n[1].map(f)\nk={}\n`x`'
+    assert minify('a = b\n++c\nif (a) {\n  d = `x\n  ${ a }`\n} else e = / re /g  // f\ng = 1 .toString()\nreturn\nh - -i') == 'a=b\n++c\nif(a){d=`x\n  ${ a }`}else e=/ re /g\ng=1 .toString()\nreturn\nh- -i'
+    assert [kind for kind, _ in tokenize('a=b/c/d;e=/f/g.test(h)')] == ['name', 'punct', 'name', 'punct', 'name', 'punct', 'name', 'punct', 'name', 'punct', 'regex', 'punct', 'name', 'punct', 'name', 'punct']
+    script = '''x=new Uint8Array(9);y=new Uint8Array(x);z=[...Uint8Array.of(1)]
+for(j=0;j<x.buffer.byteLength+y.buffer.byteLength+z.buffer.byteLength;j++)x.buffer,y.buffer,z.buffer
+g=(Image,k)=>Image+k;g(Image,Image)'''
+    mined = mine_aliases(script, aliases='')
+    assert mined == "\nA = Uint8Array\nB = 'buffer'\nC = 'byteLength'\n", mined
+    assert "'Image'" not in mined and 'Image\n' not in mined
+    assert uglify(script, mined) == '''A=Uint8Array
+B='buffer'
+C='byteLength'
+x=new A(9);y=new A(x);z=[...A.of(1)]
+for(j=0;j<x[B][C]+y[B][C]+z[B][C];j++)x[B],y[B],z[B]
+g=(Image,k)=>Image+k;g(Image,Image)'''
+    assert mine_aliases('a="Uint8Array";b=new Uint8Array;c=new Uint8Array;d=new Uint8Array') == ''
+
+    text, used = crush(script * 3, 'PQRSTUVW')
+    assert len(text) < len(script) * 2, len(text)
+    for token in used:
+        *parts, sub = text.split(token)
+        text = sub.join(parts)
+    assert text == script * 3
+    assert pack('x=1') == 'x=1'
+    payload = '`' + 'x' * 100 + '`'
+    assert pack(f'a={payload};' + script * 3).startswith(f'A={payload}\nB=`a=A;')
+    substituted = '`${y}' + 'z' * 100 + '`'
+    assert not pack(f'a={payload};y=1;b={substituted};' + script * 20).startswith(f'A={payload}\nB={substituted}'), 'Must not be evaluated before y is defined'
+
+    decoder, call = split_decoder(f'a={payload};b=1;c=D.createElement`p`;d={{e:2}}')
+    assert decoder == 'ztml=(...A)=>{a=A[0];b=A[1];c=D.createElement`p`;d={e:A[2]}}\n', decoder
+    assert call == f'ztml({payload},1,2)', call
+
+
+if __name__ == '__main__':
+    test()
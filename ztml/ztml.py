@@ -4,10 +4,14 @@
 import argparse
 from base64 import b64encode
 import chardet
+from contextlib import ExitStack
+from hashlib import sha1
 import os
 import sys
+from tempfile import NamedTemporaryFile
 from time import time
-from typing import AnyStr, Optional, overload, Tuple, Union
+from typing import AnyStr, List, Optional, overload, Tuple, Union
+from urllib.parse import quote
 
 try:
     from typing import Literal
@@ -15,13 +19,13 @@ except ImportError:
     from typing_extensions import Literal
 
 if not __package__:
-    import base125, bwt_mtf, crenc, default_vars, deflate, huffman, text_prep, validation, webify
+    import base125, base139, bwt_mtf, crenc, default_vars, deflate, dictionary, engine, huffman, reference, text_prep, validation, webify
 else:
     # noinspection PyPackages
-    from . import base125, bwt_mtf, crenc, default_vars, deflate, huffman, text_prep, validation, webify
+    from . import base125, base139, bwt_mtf, crenc, default_vars, deflate, dictionary, engine, huffman, reference, text_prep, validation, webify
 
 
-bin2txt_encodings = ['base64', 'base125', 'crenc']
+bin2txt_encodings = ['base64', 'base125', 'base139', 'crenc']
 default_bin2txt = 'crenc'
 
 
@@ -35,7 +39,14 @@ def ztml(data: AnyStr, filename: str = ..., reduce_whitespace: bool = ...,
          replace_quoted: bool = ..., lang: str = ..., mobile: bool = ...,
          title: str = ..., text_var: str = ..., validate: Literal[False] = ...,
          ignore_regex: str = ..., browser: validation.BrowserType = ...,
-         timeout: int = ..., verbose: bool = ...) -> bytes: ...
+         timeout: int = ..., crenc_lookup: bool = ...,
+         auto_aliases: bool = ..., pack: bool = ...,
+         minify: bool = ..., shared_decoder: bool = ...,
+         sidecar: bool = ..., worker: bool = ...,
+         progressive: bool = ..., fused_text_decoder: bool = ...,
+         timing: bool = ..., dict_words: int = ...,
+         signal_done: bool = ..., optimize_offset: bool = ...,
+         verbose: bool = ...) -> bytes: ...
 
 
 @overload
@@ -48,7 +59,14 @@ def ztml(data: AnyStr, filename: str = ..., reduce_whitespace: bool = ...,
          lang: str = ..., mobile: bool = ..., title: str = ...,
          text_var: str = ..., validate: Literal[True] = ...,
          ignore_regex: str = ..., browser: validation.BrowserType = ...,
-         timeout: int = ..., verbose: bool = ...) -> Tuple[bytes, int]: ...
+         timeout: int = ..., crenc_lookup: bool = ...,
+         auto_aliases: bool = ..., pack: bool = ...,
+         minify: bool = ..., shared_decoder: bool = ...,
+         sidecar: bool = ..., worker: bool = ...,
+         progressive: bool = ..., fused_text_decoder: bool = ...,
+         timing: bool = ..., dict_words: int = ...,
+         signal_done: bool = ..., optimize_offset: bool = ...,
+         verbose: bool = ...) -> Tuple[bytes, int]: ...
 
 
 @overload
@@ -61,7 +79,14 @@ def ztml(data: AnyStr, filename: str = ..., reduce_whitespace: bool = ...,
          lang: str = ..., mobile: bool = ..., title: str = ...,
          text_var: str = ..., validate: bool = ..., ignore_regex: str = ...,
          browser: validation.BrowserType = ..., timeout: int = ...,
-         verbose: bool = ...) -> Union[bytes, Tuple[bytes, int]]: ...
+         crenc_lookup: bool = ..., auto_aliases: bool = ...,
+         pack: bool = ..., minify: bool = ...,
+         shared_decoder: bool = ..., sidecar: bool = ...,
+         worker: bool = ..., progressive: bool = ...,
+         fused_text_decoder: bool = ..., timing: bool = ...,
+         dict_words: int = ..., signal_done: bool = ...,
+         optimize_offset: bool = ..., verbose: bool = ...
+         ) -> Union[bytes, Tuple[bytes, int]]: ...
 
 
 def ztml(data,
@@ -90,87 +115,233 @@ def ztml(data,
          ignore_regex='',
          browser=validation.default_browser,
          timeout=validation.default_timeout,
+         crenc_lookup=False,
+         auto_aliases=True,
+         pack=True,
+         minify=True,
+         shared_decoder=False,
+         sidecar=False,
+         worker=False,
+         progressive=False,
+         fused_text_decoder=False,
+         timing=False,
+         dict_words=0,
+         signal_done=False,
+         optimize_offset=False,
          verbose=False
          ):
+    params = locals().copy()
     start_time = time()
     assert bin2txt in bin2txt_encodings, f'Error: bin2txt={bin2txt} not in {bin2txt_encodings}'
     assert not element_id and not image or not raw
+    assert not worker or not image, 'Error: worker is only supported for text'
+    assert not progressive or not image and not raw and not sidecar and not shared_decoder, 'Error: progressive is only supported for text, and not with raw, sidecar or shared_decoder'
     if image:
         assert isinstance(data, bytes)
-        image_data = data
+        segments = [data]
     else:
         if isinstance(data, bytes):
             data = data.decode()
         data = text_prep.normalize(data, reduce_whitespace, unix_newline, fix_punct, remove_bom)  # Reduce whitespace
-        condensed, string_decoder = text_prep.encode_and_get_js_decoder(data, caps, text_var=text_var)  # Lower case and shorten common strings
+        segments = text_prep.split_segments(data) if progressive else [data]  # Independently decodable, with a small first segment
+
+    encoding = 'cp1252' if bin2txt == 'crenc' and not sidecar else 'utf8'
+
+    def get_image_decoder(url: str = '') -> str:
+        if not worker:
+            return deflate.get_js_image_decoder(len(bits), bits_decoder + writer, bitdepth, url=url, timing=timing)
+        worker_script = deflate.get_js_worker_script(len(bits), bits_decoder, bitdepth, result_var=text_var, timing=timing)  # Decode off the main thread
+        if minify:
+            worker_script = webify.minify(worker_script)
+        if uglify:
+            worker_script = webify.uglify(worker_script, replace_quoted=replace_quoted, encoding=encoding, auto_aliases=auto_aliases)
+        return deflate.get_js_worker_decoder(worker_script, writer, result_var=text_var, url=url, timing=timing)
+
+    def encode_condensed(condensed: str, dictionary_decoder: str = '') -> Tuple[List[int], str, str, str, str, bytes]:
         bwt_mtf_text, bwt_mtf_text_decoder = bwt_mtf.encode_and_get_js_decoder(condensed, bwtsort, mtf, add_bwt_func=False, data_var=text_var)  # Burrows-Wheeler + Move-to-front transforms on text. MTF is a time-consuming op.
         huffman_bits, huffman_decoder = huffman.encode_and_get_js_decoder(bwt_mtf_text, text_var=text_var)  # Huffman encode
         bits, bwt_bits_decoder = bwt_mtf.encode_and_get_js_decoder(huffman_bits)  # Burrows-Wheeler transform on bits
-        if raw:
-            writer = f'document.close(document.write({text_var}))'  # document.close() needed to ensure that any style changes added after a script are applied
-        elif element_id:
-            writer = f'''document.body.appendChild(document.createElement`pre`).id='{element_id}'
-{element_id}.textContent={text_var}'''
-        else:
-            writer = f"document.body.style.whiteSpace='pre';document.body.textContent={text_var}"
-        bits_decoder = f'{bwt_bits_decoder}{huffman_decoder}{bwt_mtf_text_decoder}{string_decoder}{writer}'
         image_data = deflate.to_png(bits, bitdepth, ect=ect)  # PNG encode. Time-consuming op.
+        return bits, dictionary_decoder, bwt_mtf_text_decoder, huffman_decoder, bwt_bits_decoder, image_data
 
-    encoding = 'cp1252' if bin2txt == 'crenc' else 'utf8'
-    if bin2txt == 'base64':  # This is just for benchmarking and is not recommended
-        image_url = b'data:;base64,' + b64encode(image_data)
-        if not image:
-            image_decoder = f"{default_vars.image}=new Image;{default_vars.image}.src='".encode() + image_url + b"'\n"
-            out = image_decoder + deflate.get_js_image_data(len(bits), bits_decoder, bitdepth).encode()
-    else:
-        if bin2txt == 'base125':
-            bytes_decoder = base125.get_js_decoder(image_data)  # Time-consuming op. when offset==None
-        else:
-            bytes_decoder = crenc.get_js_decoder(image_data)  # Time-consuming op. when offset==None
+    def get_size(encoded: Tuple[List[int], str, str, str, str, bytes]) -> int:
+        return sum(map(len, encoded[1:]))  # Decoders and PNG
+
+    scripts = []
+    uses_modifiers = False
+    for k, segment in enumerate(segments):
         if image:
-            image_url = f"'+URL.createObjectURL(new Blob([{default_vars.bytearray}]))+'".encode()
+            image_data = segment
         else:
-            image_decoder = deflate.get_js_image_decoder(len(bits), bits_decoder, bitdepth)
-            out = webify.safe_encode(image_decoder, encoding, get_back_unused=True)
+            condensed, string_decoder = text_prep.encode_and_get_js_decoder(segment, caps, text_var=text_var, fused=fused_text_decoder)  # Lower case and shorten common strings
+            encoded = encode_condensed(condensed)
+            if dict_words:  # Only kept if the PNG and the decoders get smaller, as is rarely the case, see dictionary.py
+                with_dictionary = encode_condensed(*dictionary.encode_and_get_js_decoder(condensed, dict_words, text_var=text_var, verbose=verbose))  # Substitute frequent words with unused code points
+                if get_size(with_dictionary) < get_size(encoded):
+                    encoded = with_dictionary
+                elif verbose:
+                    print(f'Skipping the dictionary, as it adds {get_size(with_dictionary) - get_size(encoded):,} B', file=sys.stderr)
+            bits, dictionary_decoder, bwt_mtf_text_decoder, huffman_decoder, bwt_bits_decoder, image_data = encoded
+            uses_modifiers |= text_prep.get_caps_modifiers_js_decoder() in string_decoder
+            if raw:
+                writer = f'document.close(document.write({text_var}))'  # document.close() needed to ensure that any style changes added after a script are applied
+            elif k:
+                writer = f"{element_id or 'document.body'}.append({text_var})"
+            elif element_id:
+                writer = f'''document.body.appendChild(document.createElement`pre`).id='{element_id}'
+{element_id}.textContent={text_var}'''
+            else:
+                writer = f"document.body.style.whiteSpace='pre';document.body.textContent={text_var}"
+            if k < len(segments) - 1:
+                writer += f';(self.requestIdleCallback||setTimeout)({default_vars.segments}.shift())'  # Decode the next segment when idle. Safari lacks requestIdleCallback
+            elif signal_done:
+                writer += ';' + webify.get_js_signal_done()
+            if timing:  # Measure each decoder stage in the browser
+                bwt_bits_decoder = webify.get_js_timed(bwt_bits_decoder, 'bwt_bits')
+                huffman_decoder = webify.get_js_timed(huffman_decoder, 'huffman')
+                bwt_mtf_text_decoder = webify.get_js_timed(bwt_mtf_text_decoder, 'bwt_mtf')
+                dictionary_decoder = webify.get_js_timed(dictionary_decoder, 'dictionary')
+                string_decoder = webify.get_js_timed(string_decoder, 'text_prep')
+                writer = webify.get_js_timed(writer, 'render')
+            bits_decoder = f'{bwt_bits_decoder}{huffman_decoder}{bwt_mtf_text_decoder}{dictionary_decoder}{string_decoder}'
 
-    if image:
-        if element_id:
-            out = f"""document.body.appendChild(new Image).id='{element_id}'
-{element_id}.src='""".encode() + image_url + b"'"
+        if sidecar:  # The PNG is loaded by URL, avoiding bin2txt overhead and JS parsing, and can be cached separately
+            assert filename and not image, 'Error: sidecar requires an output filename, and is redundant for images'
+            sidecar_filename = os.path.splitext(filename)[0] + '.png'
+            with open(sidecar_filename, 'wb') as f:
+                f.write(image_data)
+            image_decoder = get_image_decoder(url=quote(os.path.basename(sidecar_filename)))
+            out = webify.safe_encode(image_decoder, encoding)
+        elif bin2txt == 'base64':  # This is just for benchmarking and is not recommended
+            image_url = b'data:;base64,' + b64encode(image_data)
+            if worker:
+                out = get_image_decoder(url=image_url.decode()).encode()
+            elif not image:
+                image_decoder = f"{webify.get_js_mark('image') * timing}{default_vars.image}=new Image;{default_vars.image}.src='".encode() + image_url + b"'\n"
+                out = image_decoder + deflate.get_js_image_data(len(bits), bits_decoder + writer, bitdepth, timing=timing).encode()
         else:
-            out = f"document.body.style.background='url(".encode() + image_url + b")no-repeat'"
+            if bin2txt == 'base125':
+                bytes_decoder = base125.get_js_decoder(image_data, offset=None if optimize_offset else 0)  # Time-consuming op. when optimize_offset
+            elif bin2txt == 'base139':
+                bytes_decoder = base139.get_js_decoder(image_data, offset=None if optimize_offset else 0)  # Time-consuming op. when optimize_offset
+            else:
+                bytes_decoder = crenc.get_js_decoder(image_data, lookup=crenc_lookup, verbose=verbose)  # Time-consuming op. when offset==None
+            if timing:
+                bytes_decoder = webify.get_js_timed(bytes_decoder, 'bin2txt')
+            if image:
+                image_url = f"'+URL.createObjectURL(new Blob([{default_vars.bytearray}]))+'".encode()
+            else:
+                out = webify.safe_encode(get_image_decoder(), encoding, get_back_unused=True)
 
-    if bin2txt != 'base64':
-        out = bytes_decoder + out
+        if image:
+            if element_id:
+                out = f"""document.body.appendChild(new Image).id='{element_id}'
+{element_id}.src='""".encode() + image_url + b"'"
+            else:
+                out = f"document.body.style.background='url(".encode() + image_url + b")no-repeat'"
+            if signal_done:
+                out += b';' + webify.get_js_signal_done().encode()
+
+        if bin2txt != 'base64' and not sidecar:
+            out = bytes_decoder + out
+        scripts.append(out)
+    out = scripts[0]
+    if len(scripts) > 1:  # Later segments are wrapped in functions which are called in turn
+        out = f'{default_vars.segments}=['.encode() + b','.join(b'()=>{' + script + b'}' for script in scripts[1:]) + b']\n' + out
+    if timing:
+        out = f'{default_vars.timings}={{}}\n'.encode() + out
+    if minify:
+        out = webify.minify(out, encoding)  # Strip whitespace
     if os.path.splitext(filename)[-1] == '.js':
         js = True
-    if js and uglify:
-        out = webify.uglify(out, replace_quoted=replace_quoted, encoding=encoding)
-    elif not js:
+    src = ''
+    if shared_decoder:
+        assert filename, 'Error: shared_decoder requires an output filename'
+        if uglify:  # Mined aliases depend on the counts in the page, and would version the decoder per page
+            out = webify.uglify(out, replace_quoted=replace_quoted, encoding=encoding)
+        decoder, out = webify.split_decoder(out, encoding)  # Page-specific literals are passed to the generic decoder
+        src = f'{default_vars.shared_decoder}_{sha1(decoder).hexdigest()[:10]}.js'  # Versioned by content, so it can be cached indefinitely
+        decoder_filename = os.path.join(os.path.dirname(filename), src)
+        if not os.path.exists(decoder_filename):
+            with open(decoder_filename, 'wb') as f:
+                f.write(decoder)
+        if not js:
+            out = webify.html_wrap(out, aliases='', lang=lang, encoding=encoding,
+                                   mobile=mobile, title=title, src=src)
+    elif js:
+        if uglify:
+            out = webify.uglify(out, replace_quoted=replace_quoted, encoding=encoding, auto_aliases=auto_aliases)
+        if pack:
+            out = webify.pack(out, encoding)  # Only if smaller
+    else:
         out = webify.html_wrap(out, aliases=webify.default_aliases * uglify,
                                replace_quoted=replace_quoted, lang=lang,
-                               encoding=encoding, mobile=mobile, title=title)
+                               encoding=encoding, mobile=mobile, title=title,
+                               auto_aliases=auto_aliases, pack_js=pack)
+    if caps == 'auto' and uses_modifiers and not sidecar and not shared_decoder:  # The fallback from auto caps to modifiers is only kept if it beats raw
+        with_raw = ztml(**dict(params, caps='raw', filename='', js=js, validate=False, verbose=False))
+        if len(with_raw) <= len(out):
+            if verbose:
+                print(f"Falling back to caps='raw', as caps='modifiers' adds {len(out) - len(with_raw):,} B", file=sys.stderr)
+            out = with_raw
     if filename:
         with open(filename, 'wb') as f:
             f.write(out)
     if verbose:
         print(f'Encoding took {time() - start_time :,.1f} sec.', file=sys.stderr)
+        if len(segments) > 1:  # Compare against a single segment
+            single = ztml(**dict(params, filename='', js=js, progressive=False, validate=False, verbose=False))
+            print(f'Progressive rendering with {len(segments)} segments costs {len(out) - len(single):,} B ({(len(out)/len(single) - 1) * 100:.1f}%)', file=sys.stderr)
     if validate:
-        file = webify.html_wrap(out, aliases='', encoding=encoding) if js else filename or out
+        file = webify.html_wrap(out, aliases='', encoding=encoding, src=src and (src if sidecar else validation.full_path(decoder_filename))) if js else filename or out
         by = element = ''
         if element_id:
             by = 'id'
             element = element_id
-        valid = validation.validate_html(file, data, caps, by, element, raw,
-                                         browser, timeout,
-                                         content_var=text_var,
-                                         ignore_regex=ignore_regex,
-                                         verbose=True)
+        if browser == reference.browser_name:  # Decode in Python without a browser
+            valid = reference.validate(file, data, caps, base_dir=os.path.dirname(filename), encoding=encoding)
+        else:
+            with ExitStack() as stack:
+                if sidecar:
+                    folder = os.path.dirname(os.path.abspath(filename))
+                    if js:
+                        with NamedTemporaryFile(suffix='.html', dir=folder, delete=False) as f:
+                            f.write(file)
+                        stack.callback(os.remove, f.name)
+                        file = f.name
+                    if browser != engine.browser_name:  # Serve over HTTP, as file:// would taint the canvas
+                        url = stack.enter_context(validation.serve_directory(folder))
+                        file = url + quote(os.path.basename(file))
+                valid = validation.validate_html(file, data, caps, by, element, raw,
+                                                 browser, timeout,
+                                                 content_var=text_var,
+                                                 ignore_regex=ignore_regex,
+                                                 progressive=progressive,
+                                                 timing=timing,
+                                                 done_var=default_vars.done * signal_done,
+                                                 verbose=True)
         out = out, not valid
     return out
 
 
-if __name__ == '__main__':
+def read_input(filename: str, input_encoding: str = '', image: bool = False) -> AnyStr:
+    # As read by the CLI, auto detecting the text encoding by default
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if not image:
+        if input_encoding:
+            data = data.decode(input_encoding)
+        else:
+            encoding = chardet.detect(data)['encoding'] or 'utf8'
+            try:
+                data = data.decode(encoding)
+            except UnicodeDecodeError:
+                if encoding.replace('-', '') == 'utf8':
+                    raise
+    return data
+
+
+def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument('input_filename')
     parser.add_argument('output_filename', nargs='?', default='')
@@ -179,6 +350,7 @@ if __name__ == '__main__':
     parser.add_argument('--skip_unix_newline', action='store_true')
     parser.add_argument('--fix_punct', action='store_true')
     parser.add_argument('--skip_remove_bom', action='store_true')
+    parser.add_argument('--normalize_only', action='store_true', help='Only write the normalized text, streaming the input in chunks to reduce peak memory on huge files. Encoding is auto detected from the first chunk by default')
     parser.add_argument('--caps', type=str.lower, choices=text_prep.caps_modes, default=text_prep.default_caps)
     parser.add_argument('--skip_bwtsort', action='store_true')
     parser.add_argument('--mtf', type=lambda x: None if x.lower() == 'none' else int(x), choices=bwt_mtf.mtf_variants,
@@ -198,8 +370,21 @@ if __name__ == '__main__':
     parser.add_argument('--text_var', default=default_vars.text)
     parser.add_argument('--validate', action='store_true')
     parser.add_argument('--ignore_regex', nargs='?', const='', default='')
-    parser.add_argument('--browser', type=str.lower, choices=list(validation.drivers), default=validation.default_browser)
+    parser.add_argument('--browser', type=str.lower, choices=list(validation.drivers) + [reference.browser_name, engine.browser_name], default=validation.default_browser, help=f"'{reference.browser_name}' validates with the Python reference decoder, and '{engine.browser_name}' runs the JS in an embedded engine, instead of a browser")
     parser.add_argument('--timeout', type=int, default=validation.default_timeout, help='seconds')
+    parser.add_argument('--crenc_lookup', action='store_true', help='Faster decoding of large crEnc payloads at the cost of a slightly larger decoder')
+    parser.add_argument('--skip_auto_aliases', action='store_true')
+    parser.add_argument('--skip_minify', action='store_true')
+    parser.add_argument('--skip_pack', action='store_true', help='Do not pack the code into a self-extracting eval, even when this is smaller')
+    parser.add_argument('--shared_decoder', action='store_true', help='Write the generic decoder to a separate versioned JS file next to the output, to be shared and cached by multiple pages')
+    parser.add_argument('--sidecar', action='store_true', help='Write the PNG payload to a separate file next to the output and load it by URL. Warning: requires serving over HTTP, as file:// taints the canvas')
+    parser.add_argument('--worker', action='store_true', help='Decode in a Web Worker to keep the page responsive')
+    parser.add_argument('--progressive', action='store_true', help='Encode the text as a series of independently decodable segments, so that the first screen is rendered early and the rest is appended when idle. Not supported with --raw, --sidecar and --shared_decoder')
+    parser.add_argument('--fused_text_decoder', action='store_true', help='Restore caps, the and qu in a single regex pass, avoiding intermediate copies of large texts at the cost of a larger decoder')
+    parser.add_argument('--timing', action='store_true', help=f'Measure the decoding stages in the browser with performance marks, exposed on the global {default_vars.timings} object, and report them on validation')
+    parser.add_argument('--dict_words', type=int, nargs='?', const=dictionary.default_max_words, default=0, help=f'Substitute up to this many frequent words with unused code points (default when given without a value: {dictionary.default_max_words}). Only kept if the output gets smaller. Experimental, see dictionary.py')
+    parser.add_argument('--optimize_offset', action='store_true', help='Search the Base125 or Base139 offset with the shortest output, by encoding with all 256 offsets. crEnc always searches')
+    parser.add_argument('--signal_done', action='store_true', help=f"Set the global {default_vars.done} flag to the completion time and dispatch a '{default_vars.done}' window event when rendering completes, so that validation reads the content once it is complete")
     parser.add_argument('--verbose', action='store_true')
     args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
     ext = os.path.splitext(args.input_filename)[-1][1:].lower()
@@ -207,18 +392,16 @@ if __name__ == '__main__':
         args.raw = True
     elif ext in webify.image_extensions:
         args.image = True
-    with open(args.input_filename, 'rb') as f:
-        data = f.read()
-        if not args.image:
-            if args.input_encoding:
-                data = data.decode(args.input_encoding)
-            else:
-                encoding = chardet.detect(data)['encoding'] or 'utf8'
-                try:
-                    data = data.decode(encoding)
-                except UnicodeDecodeError:
-                    if encoding.replace('-', '') == 'utf8':
-                        raise
+    if args.normalize_only:
+        input_encoding = args.input_encoding
+        if not input_encoding:
+            with open(args.input_filename, 'rb') as f:
+                input_encoding = chardet.detect(f.read(text_prep.default_chunk_size))['encoding'] or 'utf8'
+        text_prep.normalize_file(args.input_filename, args.output_filename, args.reduce_whitespace,
+                                 not args.skip_unix_newline, args.fix_punct,
+                                 not args.skip_remove_bom, input_encoding)
+        sys.exit()
+    data = read_input(args.input_filename, args.input_encoding, args.image)
     out = ztml(data, args.output_filename, args.reduce_whitespace,
                not args.skip_unix_newline, args.fix_punct,
                not args.skip_remove_bom, args.caps, not args.skip_bwtsort,
@@ -226,10 +409,19 @@ if __name__ == '__main__':
                args.element_id, args.raw, args.image, args.js,
                not args.skip_uglify, not args.skip_replace_quoted, args.lang,
                args.mobile, args.title, args.text_var, args.validate,
-               args.ignore_regex, args.browser, args.timeout, args.verbose)
+               args.ignore_regex, args.browser, args.timeout, args.crenc_lookup,
+               not args.skip_auto_aliases, not args.skip_pack,
+               not args.skip_minify, args.shared_decoder,
+               args.sidecar, args.worker, args.progressive,
+               args.fused_text_decoder, args.timing, args.dict_words,
+               args.signal_done, args.optimize_offset, args.verbose)
     result = False
     if args.validate:
         out, result = out
     if not args.output_filename:
         sys.stdout.buffer.write(out)
     sys.exit(int(result))
+
+
+if __name__ == '__main__':
+    main()